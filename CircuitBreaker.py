@@ -0,0 +1,119 @@
+# Copyright (C) 2014 and beyond by Jeremiah Morris
+# and contributing developers.
+#
+# This file is part of Metaserver.
+#
+# Metaserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Metaserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import reactor, defer
+from twisted.python import log
+from collections import deque
+
+class BreakerOpen(Exception):
+  pass
+
+class CircuitBreaker:
+
+  # Wraps a database pool. Every query gets timeout seconds to finish
+  # (the pool thread may keep running, but the caller moves on), and
+  # the outcomes of the last window calls are tracked. Once at least
+  # min_calls of them are in and failure_rate of them failed, the
+  # breaker opens: calls fail at once with BreakerOpen for
+  # reset_timeout seconds. After that a single probe call is let
+  # through; success closes the breaker, failure opens it again.
+
+  CLOSED = 'closed'
+  OPEN = 'open'
+  HALF_OPEN = 'half-open'
+
+  def __init__(self, pool, timeout=5, window=20, min_calls=5, failure_rate=0.5, reset_timeout=30, name='database'):
+    self.pool = pool
+    self.name = name
+    self.timeout = timeout
+    self.min_calls = min_calls
+    self.failure_rate = failure_rate
+    self.reset_timeout = reset_timeout
+    self.outcomes = deque(maxlen=window)
+    self.state = self.CLOSED
+    self.opened_at = None
+    self.probing = False
+    self.stats = {
+      'calls' : 0,
+      'failures' : 0,
+      'timeouts' : 0,
+      'rejected' : 0,
+      'opened' : 0 }
+
+  def runQuery(self, *args, **kw):
+    return self.call(self.pool.runQuery, *args, **kw)
+
+  def runOperation(self, *args, **kw):
+    return self.call(self.pool.runOperation, *args, **kw)
+
+  def runInteraction(self, *args, **kw):
+    return self.call(self.pool.runInteraction, *args, **kw)
+
+  def isOpen(self):
+    if self.state == self.OPEN and reactor.seconds() >= self.opened_at + self.reset_timeout:
+      self.setState(self.HALF_OPEN)
+    return self.state == self.OPEN or (self.state == self.HALF_OPEN and self.probing)
+
+  def call(self, f, *args, **kw):
+    if self.isOpen():
+      self.stats['rejected'] += 1
+      return defer.fail(BreakerOpen("database unavailable"))
+    probe = self.state == self.HALF_OPEN
+    if probe:
+      self.probing = True
+    self.stats['calls'] += 1
+    deferred = f(*args, **kw)
+    deferred.addTimeout(self.timeout, reactor)
+    deferred.addCallbacks(self.succeeded, self.failed, callbackArgs=(probe,), errbackArgs=(probe,))
+    return deferred
+
+  def succeeded(self, result, probe):
+    if probe:
+      self.probing = False
+      self.outcomes.clear()
+      self.setState(self.CLOSED)
+    self.outcomes.append(True)
+    return result
+
+  def failed(self, failure, probe):
+    self.stats['failures'] += 1
+    if failure.check(defer.TimeoutError):
+      self.stats['timeouts'] += 1
+    if probe:
+      self.probing = False
+      self.trip()
+    else:
+      self.outcomes.append(False)
+      failures = self.outcomes.count(False)
+      if self.state == self.CLOSED and len(self.outcomes) >= self.min_calls and failures >= self.failure_rate * len(self.outcomes):
+        self.trip()
+    return failure
+
+  def trip(self):
+    self.opened_at = reactor.seconds()
+    self.stats['opened'] += 1
+    self.setState(self.OPEN)
+
+  def setState(self, state):
+    if state != self.state:
+      log.msg("Circuit breaker for %s %s (was %s)" % (self.name, state, self.state))
+      self.state = state
+
+  def logStats(self):
+    s = self.stats
+    log.msg("Circuit breaker for %s %s: %d calls, %d failures (%d timeouts), %d rejected, opened %d times" % (self.name, self.state, s['calls'], s['failures'], s['timeouts'], s['rejected'], s['opened']))
@@ -22,7 +22,15 @@ import time
 
 class GameInfo:
 
+  _fmt = struct.Struct('>L4sHBxlLH10x')
+  
+  # dataChunk results are cached per verb while the advertised game time
+  # is constant; setting any of these attributes drops the cache
+  _chunk_attrs = frozenset([ 'game_id', 'start_time', 'time_left', 'user_id', 'host', 'port', 'game_data' ])
+
   def __init__(self, gid, user_id):
+    self._chunks = {}
+    self._address = None
     self.game_id = gid
     self.start_time = None
     self.time_left = None
@@ -33,14 +41,30 @@ class GameInfo:
     self.game_data = None
     self.remote_hub_id = None
     
+  def __setattr__(self, name, value):
+    if name in self._chunk_attrs:
+      self._chunks.clear()
+      if name == 'host':
+        self._address = None
+    object.__setattr__(self, name, value)
+    
   def dataChunk(self, verb):
-    _fmt = struct.Struct('>L4sHBxlLH10x')
+    chunk = self._chunks.get(verb)
+    if chunk is not None:
+      return chunk
     
     game_data = self.game_data
     gametime = -1
+    counting = False
     if self.time_left is not None:
       gametime = self.time_left
       if self.start_time is not None:
         gametime -= time.time() - self.start_time
+        counting = True
+    if self._address is None:
+      self._address = socket.inet_aton(self.host)
     
-    return _fmt.pack(self.game_id, socket.inet_aton(self.host), self.port, verb, int(gametime), self.user_id, len(game_data)) + game_data
+    chunk = self._fmt.pack(self.game_id, self._address, self.port, verb, int(gametime), self.user_id, len(game_data)) + game_data
+    if not counting:
+      self._chunks[verb] = chunk
+    return chunk
@@ -21,7 +21,7 @@ import struct
 from twisted.internet.protocol import ClientFactory, DatagramProtocol
 from twisted.internet import reactor, task
 from MetaProtocol import MetaProtocol
-from MetaPackets import unpack_strings
+from PacketSchema import Schema
 import random
 import crcmod
 
@@ -29,20 +29,22 @@ import crcmod
 
 class HelloPacket:
   code = 700
+  _schema = Schema([('version', 'cstr')])
   
   def __init__(self, data):
-    (self.version, stringlen) = unpack_strings(data)
+    self._schema.unpack_into(self, data)
 
 class JoinerInfoPacket:
   code = 701
-  _fmt_start = struct.Struct('>H')
-  _fmt_end = struct.Struct('>HH')
+  _schema = Schema([
+    ('stream_id', 'H'),
+    ('player_name', 'cstr'),
+    ('version', 'cstr'),
+    ('color', 'H'),
+    ('team', 'H') ])
   
   def __init__(self, stream_id, player_name, version, color, team):
-    self.data = self._fmt_start.pack(stream_id)
-    self.data += player_name + b'\x00'
-    self.data += version + b'\x00'
-    self.data += self._fmt_end.pack(color, team)
+    self.data = self._schema.pack(stream_id, player_name, version, color, team)
 
 class JoinPlayerPacket:
   code = 702
@@ -55,7 +57,7 @@ class CapabilitiesPacket:
   _fmt_value = struct.Struct('>L')
   
   def __init__(self, data):
-    self.data = data
+    self.data = data = bytes(data)
     self.capabilities = {}
     offset = 0
     max = len(data) - 4
@@ -71,15 +73,23 @@ class CapabilitiesPacket:
 
 class AcceptJoinPacket:
   code = 704
-  _fmt_start = struct.Struct('>BLHLHHHB')
-  _fmt_end = struct.Struct('>HHH10s')
+  _schema = Schema([
+    ('accepted', 'B'),
+    ('dsp_host', 'L'),
+    ('dsp_port', 'H'),
+    ('ddp_host', 'L'),
+    ('ddp_port', 'H'),
+    ('identifier', 'H'),
+    ('stream_id', 'H'),
+    ('net_dead', 'B'),
+    ('player_name', 'cstr'),
+    ('desired_color', 'H'),
+    ('team', 'H'),
+    ('color', 'H'),
+    ('serial_number', '10s') ])
   
   def __init__(self, player_name):
-    # accepted, dspAddress.host, dspAddress.port, ddpAddress.host, ddpAddress.port,
-    # identifier, stream_id, net_dead, player_name, desired_color, team, color, serial_number
-    self.data = self._fmt_start.pack(1, 0, 0, 0, 0, 0, 0, 0)
-    self.data += player_name + b'\x00'
-    self.data += self._fmt_end.pack(0, 0, 0, b'')
+    self.data = self._schema.pack(1, 0, 0, 0, 0, 0, 0, 0, player_name, 0, 0, 0, b'')
 
 class TopologyPacket:
   code = 705
@@ -107,11 +117,14 @@ class LuaPacket:
 
 class NetworkChatPacket:
   code = 709
-  _fmt = struct.Struct('>HHH')
+  _schema = Schema([
+    ('sender_id', 'H'),
+    ('target', 'H'),
+    ('target_id', 'H'),
+    ('message', 'cstr') ])
   
   def __init__(self, data):
-    self.sender_id, self.target, self.target_id, = self._fmt.unpack_from(data)
-    self.message, stringlen = unpack_strings(data, 1, self._fmt.size)
+    self._schema.unpack_into(self, data)
 
 class EndGameDataPacket:
   code = 711
@@ -127,11 +140,15 @@ class ServerWarningPacket:
 
 class ClientInfoPacket:
   code = 714
-  _fmt = struct.Struct('>HHHH')
+  _schema = Schema([
+    ('stream_id', 'H'),
+    ('action', 'H'),
+    ('color', 'H'),
+    ('team', 'H'),
+    ('player_name', 'cstr') ])
   
   def __init__(self, data):
-    self.stream_id, self.action, self.color, self.team, = self._fmt.unpack_from(data)
-    self.player_name, stringlen = unpack_strings(data, 1, self._fmt.size)
+    self._schema.unpack_into(self, data)
 
 class ZippedMapPacket:
   code = 715
@@ -166,23 +183,23 @@ class GameSessionPacket:
 ### connector
 class JoinerConnector(MetaProtocol):
 
-  _join_recv_packets = [
-      HelloPacket,
-      CapabilitiesPacket,
-      ServerWarningPacket,
-      ClientInfoPacket,
-      NetworkChatPacket,
-      JoinPlayerPacket,
-      GameSessionPacket,
-      TopologyPacket,
-      MapPacket,
-      PhysicsPacket,
-      LuaPacket,
-      ZippedMapPacket,
-      ZippedPhysicsPacket,
-      ZippedLuaPacket,
-      EndGameDataPacket,
-      NetworkStatsPacket
+  _recv_packets = [
+      (HelloPacket, 'handleHelloPacket', None),
+      (CapabilitiesPacket, 'handleCapabilitiesPacket', None),
+      (ServerWarningPacket, 'refusePacket', None),
+      (ClientInfoPacket, 'acceptPacket', None),
+      (NetworkChatPacket, 'acceptPacket', None),
+      (JoinPlayerPacket, 'handleJoinPlayerPacket', None),
+      (GameSessionPacket, 'acceptPacket', None),
+      (TopologyPacket, 'acceptPacket', None),
+      (MapPacket, 'acceptPacket', None),
+      (PhysicsPacket, 'acceptPacket', None),
+      (LuaPacket, 'acceptPacket', None),
+      (ZippedMapPacket, 'acceptPacket', None),
+      (ZippedPhysicsPacket, 'acceptPacket', None),
+      (ZippedLuaPacket, 'acceptPacket', None),
+      (EndGameDataPacket, 'acceptPacket', None),
+      (NetworkStatsPacket, 'acceptPacket', None)
     ]
 
   def __init__(self, tester):
@@ -200,59 +217,29 @@ class JoinerConnector(MetaProtocol):
     self.connected = True
   
   def connectionLost(self, reason):
+    self.keepalive.remove(self)
     if self.connected and not self.succeeded:
       self.tester.joinDisconnected(self, reason)
-    pass
 
-  def messageAllowed(self, code):
-    for p in self._join_recv_packets:
-      if p.code == code:
-        return True
+  def handleHelloPacket(self, packet):
+    self.tester.joinGotHello(self)
+    self.sendPacket(JoinerInfoPacket(0, self.player_name, packet.version, self.color, self.team))
+    return True
+  
+  def handleCapabilitiesPacket(self, packet):
+    # self.sendPacket(CapabilitiesPacket(packet.data))
+    # return True
+    self.tester.joinGotCapabilities(self, packet)
     return False
-
-  def packMessage(self, code, data):
-    for p in self._join_recv_packets:
-      if p.code == code:
-        return p(data)
-    return None
-    
-  def packetReceived(self, packet):
-    if isinstance(packet, HelloPacket):
-      self.tester.joinGotHello(self)
-      self.sendPacket(JoinerInfoPacket(0, self.player_name, packet.version, self.color, self.team))
-      return True
-    if isinstance(packet, CapabilitiesPacket):
-      # self.sendPacket(CapabilitiesPacket(packet.data))
-      # return True
-      self.tester.joinGotCapabilities(self, packet)
-      return False
-    if isinstance(packet, ClientInfoPacket):
-      return True
-    if isinstance(packet, JoinPlayerPacket):
-      self.sendPacket(AcceptJoinPacket(self.player_name))
-      return True
-    if isinstance(packet, GameSessionPacket):
-      return True
-    if isinstance(packet, TopologyPacket):
-      return True
-    if isinstance(packet, NetworkChatPacket):
-      return True
-    if isinstance(packet, MapPacket):
-      return True
-    if isinstance(packet, PhysicsPacket):
-      return True
-    if isinstance(packet, LuaPacket):
-      return True
-    if isinstance(packet, ZippedMapPacket):
-      return True
-    if isinstance(packet, ZippedPhysicsPacket):
-      return True
-    if isinstance(packet, ZippedLuaPacket):
-      return True
-    if isinstance(packet, EndGameDataPacket):
-      return True
-    if isinstance(packet, NetworkStatsPacket):
-      return True
+  
+  def handleJoinPlayerPacket(self, packet):
+    self.sendPacket(AcceptJoinPacket(self.player_name))
+    return True
+  
+  def acceptPacket(self, packet):
+    return True
+  
+  def refusePacket(self, packet):
     return False
 
 class JoinerConnectorFactory(ClientFactory):
@@ -0,0 +1,134 @@
+# Copyright (C) 2014 and beyond by Jeremiah Morris
+# and contributing developers.
+#
+# This file is part of Metaserver.
+#
+# Metaserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Metaserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.application import service
+from twisted.internet import reactor, defer, task
+from twisted.python import log
+
+class HostResolver(service.Service):
+
+  # Remote hub host names are resolved through reactor.resolve (or the
+  # resolve function passed in, which must return a Deferred) and kept
+  # for ttl seconds; failures and lookups taking more than timeout
+  # seconds are remembered for negative_ttl seconds, though a host that
+  # resolved before keeps its last good address.
+  # lookup() answers from the cache whenever it has an entry, even an
+  # expired one, and refreshes expired entries in the background.
+  # Every refresh_interval seconds, entries looked up since the last
+  # pass (and pinned hosts) are refreshed before they expire; the rest
+  # are dropped. generation goes up whenever a cached address changes.
+
+  def __init__(self, ttl=300, negative_ttl=30, refresh_interval=60, timeout=10, resolve=None):
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.timeout = timeout
+    self.refresh_interval = refresh_interval
+    self.resolve = resolve if resolve is not None else reactor.resolve
+    self.cache = {}       # host -> [address or None, expires, used]
+    self.resolving = {}   # host -> Deferreds waiting on the answer
+    self.pinned = set()
+    self.generation = 0
+    self.refresher = None
+    self.stats = {
+      'hits' : 0,
+      'misses' : 0,
+      'stale' : 0,
+      'resolved' : 0,
+      'failed' : 0 }
+
+  def startService(self):
+    service.Service.startService(self)
+    self.refresher = task.LoopingCall(self.refresh)
+    self.refresher.clock = reactor
+    self.refresher.start(self.refresh_interval, now=False)
+
+  def stopService(self):
+    service.Service.stopService(self)
+    if self.refresher is not None and self.refresher.running:
+      self.refresher.stop()
+    self.refresher = None
+
+  def pin(self, hosts):
+    # pinned hosts are resolved now and kept fresh even when unused
+    self.pinned = set(hosts)
+    for host in self.pinned:
+      if host not in self.cache:
+        self.startResolve(host)
+
+  def lookup(self, host):
+    # fires with the address, or None if the host does not resolve
+    entry = self.cache.get(host)
+    if entry is not None:
+      entry[2] = True
+      if entry[1] <= reactor.seconds():
+        self.stats['stale'] += 1
+        self.startResolve(host)
+      else:
+        self.stats['hits'] += 1
+      return defer.succeed(entry[0])
+    self.stats['misses'] += 1
+    d = defer.Deferred()
+    self.startResolve(host, d)
+    return d
+
+  def startResolve(self, host, waiter=None):
+    waiting = self.resolving.get(host)
+    if waiting is not None:
+      if waiter is not None:
+        waiting.append(waiter)
+      return
+    self.resolving[host] = [waiter] if waiter is not None else []
+    try:
+      deferred = self.resolve(host)
+    except Exception:
+      deferred = defer.fail()
+    deferred.addTimeout(self.timeout, reactor)
+    deferred.addCallbacks(self.resolveResult, self.resolveFailure, callbackArgs=(host,), errbackArgs=(host,))
+
+  def resolveResult(self, address, host):
+    self.stats['resolved'] += 1
+    self.finishResolve(host, address, self.ttl)
+
+  def resolveFailure(self, failure, host):
+    self.stats['failed'] += 1
+    log.msg("Can't resolve remote hub address from host %s: %s" % (host, failure.getErrorMessage()))
+    old = self.cache.get(host)
+    self.finishResolve(host, old[0] if old is not None else None, self.negative_ttl)
+
+  def finishResolve(self, host, address, ttl):
+    old = self.cache.get(host)
+    used = old[2] if old is not None else False
+    if old is not None and old[0] != address:
+      self.generation += 1
+    self.cache[host] = [address, reactor.seconds() + ttl, used]
+    for d in self.resolving.pop(host, ()):
+      d.callback(address)
+
+  def refresh(self):
+    horizon = reactor.seconds() + self.refresh_interval
+    for host, entry in list(self.cache.items()):
+      if not entry[2] and host not in self.pinned:
+        del self.cache[host]
+        continue
+      entry[2] = False
+      if entry[1] <= horizon:
+        self.startResolve(host)
+
+  def logStats(self):
+    s = self.stats
+    log.msg("%d hosts cached: %d hits, %d misses, %d stale, %d resolved, %d failed" % (len(self.cache), s['hits'], s['misses'], s['stale'], s['resolved'], s['failed']))
@@ -0,0 +1,165 @@
+# Copyright (C) 2014 and beyond by Jeremiah Morris
+# and contributing developers.
+#
+# This file is part of Metaserver.
+#
+# Metaserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Metaserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import reactor, task
+from twisted.python import log
+import math
+
+class KeepaliveWheel:
+
+  # Keepalive and idle deadlines for every connection, on one timer.
+  # Time advances in ticks of tick seconds, and each connection is
+  # filed in the slot for the tick at which it next needs a look.
+  # Receiving data only records the current tick on the connection
+  # (see touch); nothing is moved. When a slot comes up, a connection
+  # heard from since it was filed is refiled for its new deadline, and
+  # one silent for its interval is sent a keepalive, or dropped if it
+  # has already left that many keepalives unanswered. The keepalives
+  # due on a tick go out together. Deadlines are rounded up to whole
+  # ticks.
+  #
+  # Connections provide KEEPALIVE_PROFILES, a dict of profile name to
+  # (interval in seconds, keepalives allowed to go unanswered), the
+  # name of their current profile in keepalive_profile, sendKeepalive()
+  # and keepaliveTimeout(); call reschedule after changing the profile.
+  # The wheel keeps its own bookkeeping on them in _wheel_seen,
+  # _wheel_due and _wheel_misses.
+  #
+  # Per profile, saved counts the keepalives a fixed interval of
+  # baseline seconds would have sent over the same silences, less the
+  # ones actually sent; silences broken by the client are not counted.
+
+  def __init__(self, tick=0.5, slots=64, baseline=10):
+    self.tick = tick
+    self.baseline = baseline
+    self.slots = [ set() for i in range(slots) ]
+    self.now = 0
+    self.count = 0
+    self.looper = None
+    self.stats = {
+      'ticks' : 0,
+      'refiled' : 0,
+      'keepalives' : 0,
+      'timeouts' : 0,
+      'max_batch' : 0 }
+    self.profile_stats = {}   # profile name -> [keepalives, timeouts, saved]
+
+  def ticks(self, seconds):
+    return max(1, int(math.ceil(seconds / self.tick - 1e-9)))
+
+  def file(self, conn, due):
+    conn._wheel_due = due
+    self.slots[due % len(self.slots)].add(conn)
+
+  def interval(self, conn):
+    return conn.KEEPALIVE_PROFILES[conn.keepalive_profile]
+
+  def add(self, conn):
+    conn._wheel_seen = self.now
+    conn._wheel_misses = 0
+    self.file(conn, self.now + self.ticks(self.interval(conn)[0]))
+    self.count += 1
+    if self.looper is None:
+      self.looper = task.LoopingCall.withCount(self.advance)
+      self.looper.clock = reactor
+      self.looper.start(self.tick, now=False)
+
+  def remove(self, conn):
+    due = getattr(conn, '_wheel_due', None)
+    if due is None:
+      return
+    slot = self.slots[due % len(self.slots)]
+    if conn in slot:
+      slot.remove(conn)
+      self.count -= 1
+    if self.count == 0 and self.looper is not None:
+      self.looper.stop()
+      self.looper = None
+
+  def touch(self, conn):
+    # the receive path usually does this inline
+    conn._wheel_seen = self.now
+    conn._wheel_misses = 0
+
+  def reschedule(self, conn):
+    # after a profile change; a longer interval is picked up when the
+    # current deadline comes round, a shorter one needs an earlier slot
+    due = getattr(conn, '_wheel_due', None)
+    if due is None:
+      return
+    slot = self.slots[due % len(self.slots)]
+    if conn not in slot:
+      return
+    sooner = max(conn._wheel_seen + self.ticks(self.interval(conn)[0]), self.now + 1)
+    if sooner < due:
+      slot.remove(conn)
+      self.file(conn, sooner)
+
+  def advance(self, elapsed=1):
+    # elapsed is how many ticks passed since the last call; a busy
+    # reactor can skip some, and their slots are still processed
+    pinged = []
+    for i in range(elapsed):
+      self.now += 1
+      self.stats['ticks'] += 1
+      index = self.now % len(self.slots)
+      slot = self.slots[index]
+      if not slot:
+        continue
+      self.slots[index] = set()
+      for conn in slot:
+        if conn._wheel_due > self.now:
+          # due on a later turn of the wheel
+          self.slots[index].add(conn)
+          continue
+        interval, misses = self.interval(conn)
+        timeout = self.ticks(interval)
+        due = conn._wheel_seen + timeout
+        if due > self.now:
+          self.stats['refiled'] += 1
+          self.file(conn, due)
+          continue
+        s = self.profile_stats.get(conn.keepalive_profile)
+        if s is None:
+          s = self.profile_stats[conn.keepalive_profile] = [0, 0, 0]
+        if conn._wheel_misses >= misses:
+          self.count -= 1
+          self.stats['timeouts'] += 1
+          s[1] += 1
+          conn.keepaliveTimeout()
+        else:
+          conn._wheel_misses += 1
+          conn._wheel_seen = self.now
+          s[0] += 1
+          s[2] += float(timeout) / self.ticks(self.baseline) - 1
+          pinged.append(conn)
+          self.file(conn, self.now + timeout)
+    for conn in pinged:
+      conn.sendKeepalive()
+    self.stats['keepalives'] += len(pinged)
+    if len(pinged) > self.stats['max_batch']:
+      self.stats['max_batch'] = len(pinged)
+    if self.count == 0 and self.looper is not None:
+      self.looper.stop()
+      self.looper = None
+
+  def logStats(self):
+    s = self.stats
+    log.msg("Keepalive wheel: %d connections, %d ticks, %d refiled, %d keepalives (at most %d per tick), %d timeouts" % (self.count, s['ticks'], s['refiled'], s['keepalives'], s['max_batch'], s['timeouts']))
+    for name, (keepalives, timeouts, saved) in sorted(self.profile_stats.items()):
+      log.msg("Keepalive profile %s: %d keepalives, %d timeouts, %d keepalives saved against a %g s interval" % (name, keepalives, timeouts, round(saved), self.baseline))
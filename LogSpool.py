@@ -0,0 +1,256 @@
+# Copyright (C) 2014 and beyond by Jeremiah Morris
+# and contributing developers.
+#
+# This file is part of Metaserver.
+#
+# Metaserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Metaserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.application import service
+from twisted.internet import reactor, defer, task, threads
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+import ast
+import datetime
+import os
+import struct
+import zlib
+
+# The spool file is a sequence of records, each
+#
+#   length   4 bytes, big-endian, of the payload
+#   crc32    4 bytes, big-endian, of the payload
+#   payload  repr() of (table, columns, rows)
+#
+# Rows hold only bytes, str, int and None; datetimes are stored as
+# strings MySQL accepts for datetime columns. The .pos file next to the
+# spool holds the offset up to which records have been replayed.
+#
+# Records are only ever appended, so damage is confined to the tail: a
+# crash or failed write can leave a partial record there. At startup
+# the spool is cut back to the end of its last whole record before
+# anything else is appended after it.
+
+_header = struct.Struct('>LL')
+
+def encodeRecord(table, columns, rows):
+  rows = [ tuple(value.isoformat(' ') if isinstance(value, datetime.datetime) else value for value in row) for row in rows ]
+  payload = repr((table, tuple(columns), rows)).encode('utf8')
+  return _header.pack(len(payload), zlib.crc32(payload)) + payload
+
+def decodeRecords(data):
+  # returns the records and the number of bytes they used; stops at
+  # the first incomplete or damaged record
+  records = []
+  offset = 0
+  while offset + _header.size <= len(data):
+    length, crc = _header.unpack_from(data, offset)
+    end = offset + _header.size + length
+    if end > len(data):
+      break
+    payload = data[offset + _header.size:end]
+    if zlib.crc32(payload) != crc:
+      break
+    records.append(ast.literal_eval(payload.decode('utf8')))
+    offset = end
+  return records, offset
+
+class LogSpool(service.Service):
+
+  # Log rows that could not be written (the database failed, or the
+  # writer's queue was full) are appended to a local spool file. Rows
+  # are buffered and written with one write and fsync at most every
+  # sync_interval seconds. While the spool holds unreplayed records, a
+  # replayer checks every replay_interval seconds and writes them back
+  # in multi-row INSERTs of up to batch_size rows. It stops at the first
+  # failure and tries again on the next pass. Once everything is
+  # replayed the spool is truncated. Records are replayed at least
+  # once: a crash between an INSERT and the .pos update repeats it.
+
+  def __init__(self, storage, path, sync_interval=0.5, replay_interval=10, batch_size=100, read_size=262144):
+    self.storage = storage
+    self.path = path
+    self.pos_path = path + '.pos'
+    self.sync_interval = sync_interval
+    self.replay_interval = replay_interval
+    self.batch_size = batch_size
+    self.read_size = read_size
+    self.buffer = {}        # (table, columns) -> rows waiting to be written
+    self.buffered = 0
+    self.size = 0           # bytes in the spool file
+    self.pos = 0            # bytes already replayed
+    self.writing = None
+    self.syncCall = None
+    self.replaying = False
+    self.replayer = None
+    self.threadpool = ThreadPool(1, 1, 'LogSpool')
+    self.stats = {
+      'spooled' : 0,
+      'syncs' : 0,
+      'replayed' : 0,
+      'replay_failures' : 0,
+      'discarded' : 0 }
+
+  def startService(self):
+    service.Service.startService(self)
+    self.threadpool.start()
+    if os.path.exists(self.path):
+      self.size = os.path.getsize(self.path)
+    if os.path.exists(self.pos_path):
+      with open(self.pos_path) as f:
+        self.pos = min(int(f.read().strip() or 0), self.size)
+    if self.size > self.pos:
+      self.recover()
+    if self.size > self.pos:
+      log.msg("Log spool %s holds %d bytes to replay" % (self.path, self.size - self.pos))
+    self.replayer = task.LoopingCall(self.replay)
+    self.replayer.clock = reactor
+    self.replayer.start(self.replay_interval, now=False)
+
+  def recover(self):
+    # runs before the reactor does, so the blocking reads are harmless
+    end = scanRecords(self.path, self.pos)
+    if end < self.size:
+      log.msg("Discarding %d damaged bytes at the end of log spool %s" % (self.size - end, self.path))
+      self.stats['discarded'] += 1
+      with open(self.path, 'r+b') as f:
+        f.truncate(end)
+        os.fsync(f.fileno())
+      self.size = end
+
+  @defer.inlineCallbacks
+  def stopService(self):
+    service.Service.stopService(self)
+    if self.replayer is not None and self.replayer.running:
+      self.replayer.stop()
+    self.replayer = None
+    while self.buffer or self.writing is not None:
+      if self.writing is not None:
+        yield self.writing
+      else:
+        yield self.sync()
+    self.threadpool.stop()
+
+  def backlog(self):
+    # bytes in the spool file still to be replayed
+    return self.size - self.pos
+
+  def append(self, table, columns, rows):
+    key = (table, tuple(columns))
+    self.buffer.setdefault(key, []).extend(rows)
+    self.buffered += len(rows)
+    self.stats['spooled'] += len(rows)
+    if self.syncCall is None and self.writing is None:
+      self.syncCall = reactor.callLater(self.sync_interval, self.sync)
+
+  def inThread(self, f, *args):
+    return threads.deferToThreadPool(reactor, self.threadpool, f, *args)
+
+  def sync(self):
+    self.syncCall = None
+    if not self.buffer or self.writing is not None:
+      return defer.succeed(None)
+    data = b''.join(encodeRecord(table, columns, rows) for (table, columns), rows in self.buffer.items())
+    self.buffer = {}
+    self.buffered = 0
+    self.writing = self.inThread(self.writeFile, data, self.size)
+    self.writing.addCallbacks(self.syncDone, self.syncFailed, callbackArgs=(len(data),))
+    return self.writing
+
+  def writeFile(self, data, size):
+    with open(self.path, 'ab') as f:
+      try:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+      except Exception:
+        # don't leave part of a record for later ones to follow
+        f.truncate(size)
+        raise
+
+  def syncDone(self, result, length):
+    self.writing = None
+    self.size += length
+    self.stats['syncs'] += 1
+    if self.buffer and self.syncCall is None:
+      self.syncCall = reactor.callLater(self.sync_interval, self.sync)
+
+  def syncFailed(self, failure):
+    self.writing = None
+    self.stats['discarded'] += 1
+    log.msg("Log spool write failure: %s" % str(failure))
+
+  @defer.inlineCallbacks
+  def replay(self):
+    if self.replaying or self.size <= self.pos or self.writing is not None:
+      return
+    if self.storage.breaker is not None and self.storage.breaker.isOpen():
+      return
+    self.replaying = True
+    try:
+      while self.size > self.pos:
+        data = yield self.inThread(self.readFile, self.pos, self.read_size)
+        records, used = decodeRecords(data)
+        if used == 0:
+          if len(data) < self.size - self.pos and len(data) >= self.read_size:
+            # a record larger than one read; read it whole next time
+            self.read_size *= 2
+            continue
+          log.msg("Discarding %d damaged bytes at the end of log spool %s" % (self.size - self.pos, self.path))
+          self.stats['discarded'] += 1
+          yield self.advance(self.size)
+          break
+        batches = {}
+        for table, columns, rows in records:
+          batches.setdefault((table, columns), []).extend(rows)
+        for (table, columns), rows in batches.items():
+          for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            yield self.storage.insertRows(table, columns, batch)
+            self.stats['replayed'] += len(batch)
+        yield self.advance(self.pos + used)
+      if self.pos == self.size and self.writing is None:
+        yield self.inThread(self.truncate)
+        self.size = self.pos = 0
+        log.msg("Log spool %s replayed" % self.path)
+    except Exception as e:
+      self.stats['replay_failures'] += 1
+      log.msg("Log spool replay failure: %s" % e)
+    finally:
+      self.replaying = False
+
+  def readFile(self, offset, length):
+    with open(self.path, 'rb') as f:
+      f.seek(offset)
+      return f.read(length)
+
+  def advance(self, pos):
+    self.pos = pos
+    return self.inThread(self.writePos, pos)
+
+  def writePos(self, pos):
+    temp = self.pos_path + '.tmp'
+    with open(temp, 'w') as f:
+      f.write('%d\n' % pos)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(temp, self.pos_path)
+
+  def truncate(self):
+    with open(self.path, 'wb') as f:
+      os.fsync(f.fileno())
+    self.writePos(0)
+
+  def logStats(self):
+    s = self.stats
+    log.msg("Log spool: %d rows spooled, %d replayed, %d rows buffered, %d bytes to replay, %d syncs, %d replay failures" % (s['spooled'], s['replayed'], self.buffered, self.backlog(), s['syncs'], s['replay_failures']))
@@ -0,0 +1,168 @@
+# Copyright (C) 2014 and beyond by Jeremiah Morris
+# and contributing developers.
+#
+# This file is part of Metaserver.
+#
+# Metaserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Metaserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.application import service
+from twisted.internet import reactor, defer
+from twisted.python import log
+from CircuitBreaker import BreakerOpen
+import datetime
+import time
+
+class LogWriter(service.Service):
+
+  # Log rows are queued in memory and written as multi-row INSERTs, one
+  # per table and column set, once batch_size rows are waiting or
+  # flush_interval seconds after the first queued row. event_date is
+  # taken when the row is queued. At most max_inflight INSERTs run at
+  # once, so logging cannot crowd login queries out of the database
+  # pool. Rows queued or being written never exceed max_queue. Rows
+  # past that, and batches the database rejects, go to the spool if
+  # there is one; otherwise they are dropped and counted.
+
+  def __init__(self, storage, batch_size=100, flush_interval=1.0, max_queue=10000, max_inflight=2, spool=None):
+    self.storage = storage
+    self.spool = spool
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.max_queue = max_queue
+    self.max_inflight = max_inflight
+    self.pending = {}     # (table, columns) -> rows
+    self.queued = 0
+    self.writing = 0
+    self.inflight = 0
+    self.flushCall = None
+    self.flushing = False
+    self.stopping = None
+    self.stats = {
+      'queued' : 0,
+      'written' : 0,
+      'batches' : 0,
+      'dropped' : 0,
+      'failed' : 0,
+      'spooled' : 0,
+      'max_depth' : 0,
+      'flush_time' : 0.0,
+      'max_flush_time' : 0.0 }
+    self.reported_drops = 0
+
+  def stopService(self):
+    service.Service.stopService(self)
+    # wait for everything queued so far to reach the database
+    self.stopping = defer.Deferred()
+    self.flush()
+    if self.queued == 0 and self.inflight == 0:
+      self.stopping, d = None, self.stopping
+      d.callback(None)
+      return d
+    return self.stopping
+
+  def depth(self):
+    return self.queued + self.writing
+
+  def write(self, table, **columns):
+    columns['event_date'] = datetime.datetime.now()
+    if self.depth() >= self.max_queue:
+      if self.spool is not None:
+        self.spool.append(table, columns, [ tuple(columns.values()) ])
+        self.stats['spooled'] += 1
+      else:
+        self.stats['dropped'] += 1
+      return False
+    key = (table, tuple(columns))
+    rows = self.pending.get(key)
+    if rows is None:
+      rows = self.pending[key] = []
+    rows.append(tuple(columns.values()))
+    self.queued += 1
+    self.stats['queued'] += 1
+    if self.depth() > self.stats['max_depth']:
+      self.stats['max_depth'] = self.depth()
+    if len(rows) >= self.batch_size:
+      self.flush()
+    elif self.flushCall is None:
+      self.flushCall = reactor.callLater(self.flush_interval, self.flush)
+    return True
+
+  def flush(self):
+    if self.flushCall is not None:
+      if self.flushCall.active():
+        self.flushCall.cancel()
+      self.flushCall = None
+    self.flushing = True
+    try:
+      for key in list(self.pending):
+        rows = self.pending[key]
+        while rows and self.inflight < self.max_inflight:
+          batch = rows[:self.batch_size]
+          del rows[:self.batch_size]
+          self.writeBatch(key, batch)
+        if not rows:
+          del self.pending[key]
+    finally:
+      self.flushing = False
+    if self.stats['dropped'] > self.reported_drops:
+      log.msg("Log queue full, dropped %d rows" % (self.stats['dropped'] - self.reported_drops))
+      self.reported_drops = self.stats['dropped']
+
+  def writeBatch(self, key, batch):
+    table, columns = key
+    self.queued -= len(batch)
+    self.writing += len(batch)
+    self.inflight += 1
+    started = time.perf_counter()
+    deferred = self.storage.insertRows(table, columns, batch)
+    deferred.addCallbacks(self.batchWritten, self.batchFailed, callbackArgs=(table, len(batch), started), errbackArgs=(key, batch))
+    deferred.addBoth(self.batchDone, len(batch))
+
+  def batchWritten(self, result, table, count, started):
+    elapsed = time.perf_counter() - started
+    self.stats['written'] += count
+    self.stats['batches'] += 1
+    self.stats['flush_time'] += elapsed
+    if elapsed > self.stats['max_flush_time']:
+      self.stats['max_flush_time'] = elapsed
+
+  def batchFailed(self, failure, key, batch):
+    table, columns = key
+    if not failure.check(BreakerOpen):
+      log.msg("Database failure writing %d %s rows: %s" % (len(batch), table, str(failure)))
+    if self.spool is not None:
+      self.spool.append(table, columns, batch)
+      self.stats['spooled'] += len(batch)
+    else:
+      self.stats['failed'] += len(batch)
+
+  def batchDone(self, result, count):
+    self.writing -= count
+    self.inflight -= 1
+    if self.flushing:
+      return
+    if self.pending:
+      # keep draining a backlog; a partial batch waits for its timer
+      if self.stopping is not None or self.flushCall is None or any(len(rows) >= self.batch_size for rows in self.pending.values()):
+        self.flush()
+    elif self.stopping is not None and self.inflight == 0:
+      self.stopping, d = None, self.stopping
+      d.callback(None)
+
+  def logStats(self):
+    s = self.stats
+    batches = s['batches'] or 1
+    log.msg("Log writer: %d rows queued (%d written, %d waiting, %d writing, %d spooled, %d dropped, %d failed), %d batches, %.1f ms average, %.1f ms worst flush, %d deepest queue" % (s['queued'], s['written'], self.queued, self.writing, s['spooled'], s['dropped'], s['failed'], s['batches'], 1000 * s['flush_time'] / batches, 1000 * s['max_flush_time'], s['max_depth']))
+    if self.spool is not None:
+      self.spool.logStats()
@@ -19,43 +19,24 @@
 import struct
 import socket
 import time
+from PacketSchema import Schema
+
+_player_data_fields = [
+  (None, '2x'),
+  ('away', 'H'),
+  ('player_color', '3H'),
+  (None, '2x'),
+  ('team_color', '3H'),
+  (None, '2x'),
+  ('order', 'H'),
+  ('client_version', 'H'),
+  (None, '14x'),
+  ('player_name', 'cstr'),
+  ('team_name', 'cstr') ]
 
-def unpack_strings(data, num_strings=1, offset=0):
-  maxp = len(data)
-  p = offset
-  cur_string = b''
-  all_strings = []
-  
-  for i in range(num_strings):
-    foundstring = b''
-    if p < maxp:
-      nextnull = data.find(b'\x00', p)
-      if nextnull < 0:
-        p = maxp
-      else:
-        foundstring = data[p:nextnull]
-        p = nextnull + 1
-    all_strings.append(foundstring)
-  
-  all_strings.append(p - offset)
-  return tuple(all_strings)
-
-
-class PlayerDataChunk:
-  _fmt = struct.Struct('>xxHHHH2xHHH2xHH14x')
-  
-  @staticmethod
-  def unpack_into(object, data, offset=0):
-    object.away, pri_r, pri_g, pri_b, sec_r, sec_g, sec_b, object.order, object.client_version = PlayerDataChunk._fmt.unpack_from(data, offset)
-    
-    object.player_color = [ pri_r, pri_g, pri_b ]
-    object.team_color = [ sec_r, sec_g, sec_b ]
-    
-    object.player_name, object.team_name, stringlen = unpack_strings(data, 2, offset + PlayerDataChunk._fmt.size)
-  
 class MessagePacket:
   code = 3
-  _fmt = struct.Struct('>L')
+  _schema = Schema([('which', 'L'), ('message', 'cstr')])
   
   SYNTAX_ERROR = 0
   GAMES_NOT_ALLOWED = 1
@@ -91,32 +72,36 @@ class MessagePacket:
     "The desired room is full!".encode('mac_roman'),
     "Your account has been locked".encode('mac_roman'),
     "The game server for your product has been shutdown".encode('mac_roman') ]
+  _packed = list(map(_schema.pack, range(len(_messages)), _messages))
   
   def __init__(self, which):
-    self.data = self._fmt.pack(which) + self._messages[which] + b'\x00'
+    self.data = self._packed[which]
 
 
 class LoginPacket:
   code = 100
-  _fmt = struct.Struct('>HHLLHH32s32s32s32s')
+  _schema = Schema([
+    ('platform_type', 'H'),
+    ('metaserver_version', 'H'),
+    ('flags', 'L'),
+    ('user_id', 'L'),
+    ('max_authentication', 'H'),
+    (None, 'H'),  # player data size
+    ('service_name', '32z'),
+    ('build_date', '32z'),
+    ('build_time', '32z'),
+    ('username', '32z') ] + _player_data_fields)
 
   def __init__(self, data):
-    self.platform_type, self.metaserver_version, self.flags, self.user_id, self.max_authentication, player_data_size, self.service_name, self.build_date, self.build_time, self.username = self._fmt.unpack_from(data)
-    
-    self.service_name = self.service_name.rstrip(b'\x00')
-    self.build_date   = self.build_date.rstrip(b'\x00')
-    self.build_time   = self.build_time.rstrip(b'\x00')
-    self.username     = self.username.rstrip(b'\x00')
-    
-    PlayerDataChunk.unpack_into(self, data, self._fmt.size)
+    self._schema.unpack_into(self, data)
 
 class PasswordResponsePacket:
   code = 109
   private = True
-  _fmt = struct.Struct('>16s')
+  _schema = Schema([('password_data', '16s')])
 
   def __init__(self, data):
-    self.password_data, = self._fmt.unpack_from(data)
+    self._schema.unpack_into(self, data)
       
   def decode_password(self, auth_type=0, salt=b''):
     if auth_type == 0:  # plaintext
@@ -140,47 +125,45 @@ class LogoutPacket:
 
 class RemoteHubRequestPacket:
   code = 122
+  _schema = Schema([('network_version', 'cstr')])
 
   def __init__(self, data):
-    (self.network_version, stringlen) = unpack_strings(data)
+    self._schema.unpack_into(self, data)
 
 class RoomLoginPacket:
   code = 101
-  _fmt = struct.Struct('>32s')
+  _schema = Schema([('token', '32z'), ('username', 'cstr')])
   
   def __init__(self, data):
-    self.token, = self._fmt.unpack_from(data)
-    self.token = self.token.rstrip(b'\x00')
-    self.username, stringlen = unpack_strings(data, 1, self._fmt.size)
+    self._schema.unpack_into(self, data)
 
 class PlayerDataPacket:
   code = 103
+  _schema = Schema(_player_data_fields)
   
   def __init__(self, data):
-    PlayerDataChunk.unpack_into(self, data)
+    self._schema.unpack_into(self, data)
 
 class PlayerModePacket:
   code = 107
-  _fmt = struct.Struct('>H')
+  _schema = Schema([('deaf', 'H'), ('session_id', 'rest')])
   
   def __init__(self, data):
-    self.deaf, = self._fmt.unpack_from(data)
-    self.session_id = data[self._fmt.size:len(data)]
+    self._schema.unpack_into(self, data)
 
 class CreateGamePacket:
   code = 104
-  _fmt = struct.Struct('>HH')
+  _schema = Schema([('port', 'H'), ('remote_server_id', 'H'), ('game_data', 'rest')])
   
   def __init__(self, data):
-    self.port, self.remote_server_id = self._fmt.unpack_from(data)
-    self.game_data = data[self._fmt.size:len(data)]
+    self._schema.unpack_into(self, data)
 
 class StartGamePacket:
   code = 114
-  _fmt = struct.Struct('>l8x')
+  _schema = Schema([('game_time', 'l'), (None, '8x')])
   
   def __init__(self, data):
-    self.game_time, = self._fmt.unpack_from(data)
+    self._schema.unpack_into(self, data)
 
 class RemoveGamePacket:
   code = 105
@@ -190,20 +173,34 @@ class RemoveGamePacket:
 
 class IncomingChatPacket:
   code = 200
-  _fmt = struct.Struct('>12xH2xLL')
+  _schema = Schema([
+    (None, '12x'),
+    ('flags', 'H'),
+    (None, '2x'),
+    ('sender_id', 'L'),
+    ('target_id', 'L'),
+    ('sender_name', 'cstr'),
+    ('message', 'cstr') ])
   
   def __init__(self, data):
-    self.flags, self.sender_id, self.target_id = self._fmt.unpack_from(data)
-    self.sender_name, self.message, stringlen = unpack_strings(data, 2, self._fmt.size)
+    self._schema.unpack_into(self, data)
 
 class IncomingPrivateMessagePacket:
   code = 201
   private = True
-  _fmt = struct.Struct('>LL12xH2xLL')
+  _schema = Schema([
+    ('header_target_id', 'L'),
+    ('echo', 'L'),
+    (None, '12x'),
+    ('flags', 'H'),
+    (None, '2x'),
+    ('sender_id', 'L'),
+    ('target_id', 'L'),
+    ('sender_name', 'cstr'),
+    ('message', 'cstr') ])
   
   def __init__(self, data):
-    self.header_target_id, self.echo, self.flags, self.sender_id, self.target_id = self._fmt.unpack_from(data)
-    self.sender_name, self.message, stringlen = unpack_strings(data, 2, self._fmt.size)
+    self._schema.unpack_into(self, data)
 
 class IncomingKeepAlivePacket:
   code = 202
@@ -222,75 +219,87 @@ class AcceptPacket:
 
 class SeedPacket:
   code = 6
-  _fmt = struct.Struct('>h16s')
+  _schema = Schema([('max_auth', 'h'), ('seed', '16s')])
   
   def __init__(self, max_auth, seed):
-    self.data = self._fmt.pack(max_auth, seed)
+    self.data = self._schema.pack(max_auth, seed)
 
 class LoginSuccessfulPacket:
   code = 7
-  _fmt = struct.Struct('>L4x32s')
+  _schema = Schema([('user_id', 'L'), (None, '4x'), ('token', '32s')])
   
   def __init__(self, user_id, token):
-    self.data = self._fmt.pack(user_id, token)
+    self.data = self._schema.pack(user_id, token)
 
 class RoomListPacket:
   code = 0
-  _fmt = struct.Struct('>4x4sH14x')
+  _schema = Schema([(None, '4x'), ('host', '4s'), ('port', 'H'), (None, '14x')])
   
   def __init__(self, host, port):
-    self.data = self._fmt.pack(socket.inet_aton(host), port)
+    self.data = self._schema.pack(socket.inet_aton(host), port)
     
 class RemoteHubListPacket:
   code = 18
-  _fmt = struct.Struct('>H4sH')
+  _schema = Schema([('server_id', 'H'), ('host', '4s'), ('port', 'H')])
   
   def __init__(self, remote_servers):
-    self.data = b''.join(self._fmt.pack(server_id, socket.inet_aton(host), port) for server_id, host, port in remote_servers)
+    pack = self._schema.pack
+    self.data = b''.join(pack(server_id, socket.inet_aton(host), port) for server_id, host, port in remote_servers)
 
 class RoomLoginSuccessfulPacket:
   code = 9
-  _fmt = struct.Struct('>L4x')
+  _schema = Schema([('user_id', 'L'), (None, '4x')])
   
   def __init__(self, user_id):
-    self.data = self._fmt.pack(user_id)
+    self.data = self._schema.pack(user_id)
 
 class RoomMessagePacket:
   code = 10
+  _schema = Schema([('message', 'cstr')])
   
   def __init__(self, message):
-    self.data = message + b'\x00'
+    self.data = self._schema.pack(message)
 
 class PlayerListPacket:
   code = 1
   
-  def __init__(self, player_list, verb):
-    self.data = b''
-    for user_info in player_list:
-      self.data += user_info.roomPlayerDataChunk(verb)
+  def __init__(self, player_list, verb=None):
+    if verb is None:
+      # player_list holds (verb, user_info) pairs
+      self.data = b''.join([ user_info.roomPlayerDataChunk(verb) for verb, user_info in player_list ])
+    else:
+      self.data = b''.join([ user_info.roomPlayerDataChunk(verb) for user_info in player_list ])
 
 class GameListPacket:
   code = 2
   
   def __init__(self, game_list, verb):
-    self.data = b''
-    for game_info in game_list:
-      self.data += game_info.dataChunk(verb)
+    self.data = b''.join([ game_info.dataChunk(verb) for game_info in game_list ])
+
+_chat_fields = [
+  (None, 'H'),
+  ('length', 'H'),
+  ('color', '3H'),
+  (None, '2x'),
+  ('flags', 'H'),
+  (None, '2x'),
+  ('sender_id', 'L'),
+  ('target_id', 'L'),
+  ('sender_name', 'cstr'),
+  ('message', 'cstr') ]
 
 class OutgoingChatPacket:
   code = 200
-  _fmt = struct.Struct('>HHHHH2xH2xLL')
+  _schema = Schema(_chat_fields)
   
   def __init__(self, user_info, message):
     chatname = user_info.chatname
-    color = user_info.player_info.player_color
-    self.data = self._fmt.pack(0, 26 + len(chatname) + len(message), color[0], color[1], color[2], 0, user_info.user_id, 0) + chatname + b'\x00' + message + b'\x00'
+    self.data = self._schema.pack(0, 26 + len(chatname) + len(message), user_info.player_info.player_color, 0, user_info.user_id, 0, chatname, message)
 
 class OutgoingPrivateMessagePacket:
   code = 201
-  _fmt = struct.Struct('>LLHHHHH2xH2xLL')
+  _schema = Schema([('header_target_id', 'L'), ('echo', 'L')] + _chat_fields)
   
   def __init__(self, user_info, target_id, message):
     chatname = user_info.chatname
-    color = user_info.player_info.player_color
-    self.data = self._fmt.pack(target_id, 1, 0, 26 + len(chatname) + len(message), color[0], color[1], color[2], 1, user_info.user_id, target_id) + chatname + b'\x00' + message + b'\x00'
+    self.data = self._schema.pack(target_id, 1, 0, 26 + len(chatname) + len(message), user_info.player_info.player_color, 1, user_info.user_id, target_id, chatname, message)
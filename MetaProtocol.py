@@ -17,107 +17,197 @@
 # along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
 
 from twisted.internet.protocol import Protocol
-from twisted.protocols.policies import TimeoutMixin
+from twisted.internet import reactor
 from twisted.python import log
 from twisted.internet.error import ConnectionDone
 from MetaPackets import *
+from KeepaliveWheel import KeepaliveWheel
 import pprint
 
-class MetaProtocol(Protocol, TimeoutMixin):
+class MetaProtocol(Protocol):
 
-  TIMEOUT = 10
+  # A connection silent for its profile's interval is sent a keepalive,
+  # and is dropped once it has left that profile's number of misses
+  # unanswered and stayed silent for another interval. Subclasses pick
+  # the profile from the connection's state. The deadlines of all
+  # connections are kept in one shared wheel.
+  KEEPALIVE_PROFILES = {
+    'handshake' : (10, 1),
+    'active' : (10, 1),
+    'ingame' : (30, 2),
+    'afk' : (30, 1) }
+  keepalive_profile = 'handshake'
+  keepalive = KeepaliveWheel()
   MAX_LENGTH = 10240
   SIGNATURE = 0xDEAD
   _fmt = struct.Struct('>HHL')
-  _all_recv_packets = [ LoginPacket, PasswordResponsePacket, RemoteHubRequestPacket, LocalizationPacket, LogoutPacket, RoomLoginPacket, PlayerDataPacket, PlayerModePacket, CreateGamePacket, StartGamePacket, RemoveGamePacket, IncomingChatPacket, IncomingPrivateMessagePacket, IncomingKeepAlivePacket ]
+  
+  # Outbound frames are queued and written together with writeSequence
+  # once per reactor turn (or after OUTBOUND_DELAY seconds), or as soon
+  # as OUTBOUND_MAX_BYTES are waiting.
+  OUTBOUND_DELAY = 0
+  OUTBOUND_MAX_BYTES = 16384
+  outbound_stats = { 'frames' : 0, 'writes' : 0 }
+  
+  # Subclasses list the packets they accept as
+  #   (packet class, handler method name, states it is accepted in)
+  # A handler of None eats the packet; states of None accepts it in any
+  # state. The list is compiled into _dispatch, keyed by packet code.
+  _recv_packets = []
+  _dispatch = {}
+  
+  def __init_subclass__(cls, **kwargs):
+    super().__init_subclass__(**kwargs)
+    if '_recv_packets' in cls.__dict__:
+      cls._dispatch = {}
+      for packet_class, handler, states in cls._recv_packets:
+        if handler is not None:
+          handler = getattr(cls, handler)
+        if states is not None:
+          states = frozenset(states)
+        cls._dispatch[packet_class.code] = (packet_class, handler, states)
   
   def __init__(self):
 #     Protocol.__init__(self)
-    self._unprocessed = b''
-    self._awaitingPing = False
+    self._unprocessed = bytearray()
+    self._needed = self._fmt.size
+    self._outbound = []
+    self._outbound_bytes = 0
+    self._flushCall = None
       
   def connectionMade(self):
     conn = self.transport.getPeer()
     log.msg("new connection on %s:%d" % (conn.host, conn.port))
-    self.setTimeout(self.TIMEOUT)
+    self.keepalive.add(self)
   
   def connectionLost(self, reason):
     if reason.type == ConnectionDone:
       log.msg("closed connection")
     else:
       log.msg("lost connection: %s" % str(reason))
-    self.setTimeout(None)
+    self.keepalive.remove(self)
+    if self._flushCall is not None:
+      self._flushCall.cancel()
+      self._flushCall = None
+    self._outbound = []
+    self._outbound_bytes = 0
   
-  def resetTimeout(self):
-    self._awaitingPing = False
-    TimeoutMixin.resetTimeout(self)
+  def loseConnection(self):
+    self.flushOutbound()
+    self.transport.loseConnection()
   
-  def timeoutConnection(self):
-    if self._awaitingPing:
-      # keepalive packet timed out
-      self.transport.loseConnection()
-    else:
-      self._awaitingPing = True
-      self.sendPacket(OutgoingKeepAlivePacket())
-      self.setTimeout(self.TIMEOUT)
+  def keepaliveTimeout(self):
+    # called by the wheel for a connection that stopped answering
+    self.loseConnection()
   
-  def messageAllowed(self, code):
-    for p in self._all_recv_packets:
-      if p.code == code:
-        return True
-    return False
+  def setKeepaliveProfile(self, name):
+    if name != self.keepalive_profile:
+      self.keepalive_profile = name
+      self.keepalive.reschedule(self)
   
-  def packetReceived(self, packet):
-    return False
+  def sendKeepalive(self):
+    # called by the wheel along with the other keepalives due this tick;
+    # with nothing else queued there is no need to wait for a flush
+    if self._outbound:
+      self.sendFrame(self._keepalive_frame)
+      return
+    self.transport.write(self._keepalive_frame)
+    self.outbound_stats['frames'] += 1
+    self.outbound_stats['writes'] += 1
   
-  def packMessage(self, code, data):
-    for p in self._all_recv_packets:
-      if p.code == code:
-        return p(data)
-    return None
+  def packetRejected(self, code):
+    # called for a known packet code that is not allowed in the current
+    # state; the connection is dropped afterwards
+    pass
   
-  def sendPacket(self, packet):
+  @classmethod
+  def framePacket(cls, packet):
     extradata = packet.data
     if extradata == None:
       extradata = b''
+    return cls._fmt.pack(cls.SIGNATURE, packet.code, cls._fmt.size + len(extradata)) + extradata
+  
+  def sendPacket(self, packet):
+    data = self.framePacket(packet)
     if not isinstance(packet, OutgoingKeepAlivePacket):
-      log.msg("sending %s (%d bytes)" % (packet.__class__.__name__.rsplit('.', 1).pop(), len(extradata)))
-    data = self._fmt.pack(self.SIGNATURE, packet.code, self._fmt.size + len(extradata)) + extradata
-    self.transport.write(data)
+      log.msg("sending %s (%d bytes)" % (packet.__class__.__name__.rsplit('.', 1).pop(), len(data) - self._fmt.size))
+    self.sendFrame(data)
+  
+  def sendFrame(self, data):
+    self._outbound.append(data)
+    self._outbound_bytes += len(data)
+    self.outbound_stats['frames'] += 1
+    if self._outbound_bytes >= self.OUTBOUND_MAX_BYTES:
+      self.flushOutbound()
+    elif self._flushCall is None:
+      self._flushCall = reactor.callLater(self.OUTBOUND_DELAY, self.flushOutbound)
+  
+  def flushOutbound(self):
+    if self._flushCall is not None:
+      if self._flushCall.active():
+        self._flushCall.cancel()
+      self._flushCall = None
+    if not self._outbound:
+      return
+    if len(self._outbound) == 1:
+      self.transport.write(self._outbound[0])
+    else:
+      self.transport.writeSequence(self._outbound)
+    self.outbound_stats['writes'] += 1
+    self._outbound = []
+    self._outbound_bytes = 0
   
   def sendMessage(self, which):
     self.sendPacket(MessagePacket(which))
     
   def dataReceived(self, data):
-    self.resetTimeout()
-    alldata = self._unprocessed + data
-    currentOffset = 0
+    # what KeepaliveWheel.touch does, without the call
+    self._wheel_seen = self.keepalive.now
+    self._wheel_misses = 0
+    buf = self._unprocessed
+    buf += data
+    available = len(buf)
+    if available < self._needed:
+      return  # still waiting on the rest of a header or body
     
-    while len(alldata) >= (currentOffset + self._fmt.size):
-      bodyStart = currentOffset + self._fmt.size
-      signature, code, datalen = self._fmt.unpack_from(alldata, currentOffset)
-      if signature != self.SIGNATURE or datalen > self.MAX_LENGTH or datalen < self._fmt.size or not self.messageAllowed(code):
-        self.transport.loseConnection()
-        return
-      bodyEnd = currentOffset + datalen
-      if len(alldata) < bodyEnd:
-        break
-      
-      packet = self.packMessage(code, alldata[bodyStart:bodyEnd])
-      if isinstance(packet, IncomingKeepAlivePacket):
-        pass  # we already reset the timeout, just eat the response
-      elif packet is None:  # could not unpack
-        self.transport.loseConnection()
-        return
-      else:
-        debugdata = ''
-        if not getattr(packet, 'private', False):
-           debugdata = "\n" + pprint.pformat(vars(packet))
-        log.msg("received %s (%d bytes)%s" % (packet.__class__.__name__.rsplit('.', 1).pop(), bodyEnd - bodyStart, debugdata))
-        if not self.packetReceived(packet):
-          self.transport.loseConnection()
+    # Packet bodies are handed out as memoryview slices of the receive
+    # buffer; the views must be released before the buffer is trimmed.
+    view = memoryview(buf)
+    currentOffset = 0
+    try:
+      while available >= (currentOffset + self._fmt.size):
+        bodyStart = currentOffset + self._fmt.size
+        signature, code, datalen = self._fmt.unpack_from(buf, currentOffset)
+        entry = self._dispatch.get(code)
+        if signature != self.SIGNATURE or datalen > self.MAX_LENGTH or datalen < self._fmt.size or entry is None:
+          self.loseConnection()
           return
-      
-      currentOffset = bodyEnd
+        bodyEnd = currentOffset + datalen
+        if available < bodyEnd:
+          self._needed = datalen
+          break
+        
+        packet_class, handler, states = entry
+        if states is not None and self.state not in states:
+          self.packetRejected(code)
+          self.loseConnection()
+          return
+        if handler is not None:  # keepalives already reset the timeout
+          with view[bodyStart:bodyEnd] as body:
+            packet = packet_class(body)
+          debugdata = ''
+          if not getattr(packet, 'private', False):
+             debugdata = "\n" + pprint.pformat(vars(packet))
+          log.msg("received %s (%d bytes)%s" % (packet_class.__name__, bodyEnd - bodyStart, debugdata))
+          if not handler(self, packet):
+            self.loseConnection()
+            return
+        
+        currentOffset = bodyEnd
+        self._needed = self._fmt.size
+    finally:
+      view.release()
     
-    self._unprocessed = alldata[currentOffset:]
+    del buf[:currentOffset]
+
+MetaProtocol._keepalive_frame = MetaProtocol.framePacket(OutgoingKeepAlivePacket())
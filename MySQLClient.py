@@ -0,0 +1,659 @@
+# Copyright (C) 2014 and beyond by Jeremiah Morris
+# and contributing developers.
+#
+# This file is part of Metaserver.
+#
+# Metaserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Metaserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet.protocol import Protocol
+from twisted.internet import reactor, defer
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.python import log
+from collections import deque, OrderedDict
+import datetime
+import decimal
+import hashlib
+import re
+import struct
+
+# A MySQL client speaking the wire protocol directly on the reactor,
+# in place of adbapi's thread per query. Every statement is run as a
+# server-side prepared statement, cached per connection. Commands are
+# pipelined: each connection writes requests as they come and matches
+# the responses in order. Only mysql_native_password and the fast path
+# of caching_sha2_password are supported, without TLS.
+
+CLIENT_LONG_PASSWORD = 0x00000001
+CLIENT_LONG_FLAG = 0x00000004
+CLIENT_CONNECT_WITH_DB = 0x00000008
+CLIENT_PROTOCOL_41 = 0x00000200
+CLIENT_TRANSACTIONS = 0x00002000
+CLIENT_SECURE_CONNECTION = 0x00008000
+CLIENT_PLUGIN_AUTH = 0x00080000
+
+COM_QUIT = 0x01
+COM_STMT_PREPARE = 0x16
+COM_STMT_EXECUTE = 0x17
+COM_STMT_CLOSE = 0x19
+
+TYPE_DECIMAL = 0
+TYPE_TINY = 1
+TYPE_SHORT = 2
+TYPE_LONG = 3
+TYPE_FLOAT = 4
+TYPE_DOUBLE = 5
+TYPE_NULL = 6
+TYPE_TIMESTAMP = 7
+TYPE_LONGLONG = 8
+TYPE_INT24 = 9
+TYPE_DATE = 10
+TYPE_TIME = 11
+TYPE_DATETIME = 12
+TYPE_YEAR = 13
+TYPE_NEWDECIMAL = 246
+TYPE_BLOB = 252
+TYPE_VAR_STRING = 253
+
+UNSIGNED_FLAG = 0x20
+BINARY_CHARSET = 63
+UTF8MB4_GENERAL_CI = 45
+MAX_PACKET = 0xffffff
+
+_int_formats = {
+  TYPE_TINY : ('<b', '<B', 1),
+  TYPE_SHORT : ('<h', '<H', 2),
+  TYPE_YEAR : ('<h', '<H', 2),
+  TYPE_LONG : ('<i', '<I', 4),
+  TYPE_INT24 : ('<i', '<I', 4),
+  TYPE_LONGLONG : ('<q', '<Q', 8) }
+
+class MySQLError(Exception):
+
+  def __init__(self, code, sqlstate, message):
+    Exception.__init__(self, code, message)
+    self.code = code
+    self.sqlstate = sqlstate
+    self.message = message
+
+class MySQLConnectionLost(Exception):
+  pass
+
+def readLenencInt(data, pos):
+  first = data[pos]
+  if first < 0xfb:
+    return first, pos + 1
+  if first == 0xfb:
+    return None, pos + 1
+  if first == 0xfc:
+    return struct.unpack_from('<H', data, pos + 1)[0], pos + 3
+  if first == 0xfd:
+    return struct.unpack_from('<I', data, pos + 1)[0] & 0xffffff, pos + 4
+  return struct.unpack_from('<Q', data, pos + 1)[0], pos + 9
+
+def readLenencBytes(data, pos):
+  length, pos = readLenencInt(data, pos)
+  return bytes(data[pos:pos + length]), pos + length
+
+def lenencInt(value):
+  if value < 0xfb:
+    return bytes((value,))
+  if value < 0x10000:
+    return b'\xfc' + struct.pack('<H', value)
+  if value < 0x1000000:
+    return b'\xfd' + struct.pack('<I', value)[:3]
+  return b'\xfe' + struct.pack('<Q', value)
+
+def parseError(payload):
+  code = struct.unpack_from('<H', payload, 1)[0]
+  if payload[3:4] == b'#':
+    return MySQLError(code, payload[4:9].decode('ascii'), payload[9:].decode('utf8', 'replace'))
+  return MySQLError(code, None, payload[3:].decode('utf8', 'replace'))
+
+def isEOF(payload):
+  return payload[0] == 0xfe and len(payload) < 9
+
+def nativePassword(password, scramble):
+  if not password:
+    return b''
+  stage1 = hashlib.sha1(password).digest()
+  stage2 = hashlib.sha1(stage1).digest()
+  mix = hashlib.sha1(scramble + stage2).digest()
+  return bytes(a ^ b for a, b in zip(stage1, mix))
+
+def cachingSha2Password(password, scramble):
+  if not password:
+    return b''
+  stage1 = hashlib.sha256(password).digest()
+  stage2 = hashlib.sha256(stage1).digest()
+  mix = hashlib.sha256(stage2 + scramble).digest()
+  return bytes(a ^ b for a, b in zip(stage1, mix))
+
+_auth_plugins = {
+  b'mysql_native_password' : nativePassword,
+  b'caching_sha2_password' : cachingSha2Password }
+
+_placeholder_re = re.compile(r'%(s|%)')
+
+def convertPlaceholders(sql):
+  # adbapi passes pyformat SQL through pymysql, which applies % only
+  # when arguments are given; prepared statements take ? markers
+  return _placeholder_re.sub(lambda m: '?' if m.group(1) == 's' else '%', sql)
+
+def encodeParams(args):
+  nulls = bytearray((len(args) + 7) // 8)
+  types = []
+  values = []
+  for i, value in enumerate(args):
+    if value is None:
+      nulls[i // 8] |= 1 << (i % 8)
+      types.append(struct.pack('<BB', TYPE_NULL, 0))
+    elif isinstance(value, bool):
+      types.append(struct.pack('<BB', TYPE_TINY, 0))
+      values.append(struct.pack('<b', int(value)))
+    elif isinstance(value, int):
+      if value >= 1 << 63:
+        types.append(struct.pack('<BB', TYPE_LONGLONG, 0x80))
+        values.append(struct.pack('<Q', value))
+      else:
+        types.append(struct.pack('<BB', TYPE_LONGLONG, 0))
+        values.append(struct.pack('<q', value))
+    elif isinstance(value, float):
+      types.append(struct.pack('<BB', TYPE_DOUBLE, 0))
+      values.append(struct.pack('<d', value))
+    elif isinstance(value, datetime.datetime):
+      types.append(struct.pack('<BB', TYPE_DATETIME, 0))
+      values.append(struct.pack('<BHBBBBBI', 11, value.year, value.month, value.day, value.hour, value.minute, value.second, value.microsecond))
+    elif isinstance(value, datetime.date):
+      types.append(struct.pack('<BB', TYPE_DATE, 0))
+      values.append(struct.pack('<BHBB', 4, value.year, value.month, value.day))
+    else:
+      if isinstance(value, str):
+        data = value.encode('utf8')
+        types.append(struct.pack('<BB', TYPE_VAR_STRING, 0))
+      elif isinstance(value, decimal.Decimal):
+        data = str(value).encode('ascii')
+        types.append(struct.pack('<BB', TYPE_NEWDECIMAL, 0))
+      else:
+        data = bytes(value)
+        types.append(struct.pack('<BB', TYPE_BLOB, 0))
+      values.append(lenencInt(len(data)) + data)
+  return bytes(nulls) + b'\x01' + b''.join(types) + b''.join(values)
+
+def readColumn(payload):
+  pos = 0
+  for i in range(6):  # catalog, schema, table, org_table, name, org_name
+    length, pos = readLenencInt(payload, pos)
+    pos += length
+  pos += 1  # length of the fixed fields
+  charset, length, type, flags, decimals = struct.unpack_from('<HIBHB', payload, pos)
+  return (type, flags, charset)
+
+def readBinaryRow(payload, columns):
+  count = len(columns)
+  nulls = payload[1:1 + (count + 9) // 8]
+  pos = 1 + len(nulls)
+  row = []
+  for i, (type, flags, charset) in enumerate(columns):
+    bit = i + 2
+    if nulls[bit // 8] & (1 << (bit % 8)):
+      row.append(None)
+      continue
+    fmt = _int_formats.get(type)
+    if fmt is not None:
+      row.append(struct.unpack_from(fmt[1] if flags & UNSIGNED_FLAG else fmt[0], payload, pos)[0])
+      pos += fmt[2]
+    elif type == TYPE_DOUBLE:
+      row.append(struct.unpack_from('<d', payload, pos)[0])
+      pos += 8
+    elif type == TYPE_FLOAT:
+      row.append(struct.unpack_from('<f', payload, pos)[0])
+      pos += 4
+    elif type in (TYPE_DATETIME, TYPE_TIMESTAMP, TYPE_DATE):
+      length = payload[pos]
+      parts = [0] * 7
+      if length >= 4:
+        parts[0:3] = struct.unpack_from('<HBB', payload, pos + 1)
+      if length >= 7:
+        parts[3:6] = struct.unpack_from('<BBB', payload, pos + 5)
+      if length >= 11:
+        parts[6] = struct.unpack_from('<I', payload, pos + 8)[0]
+      pos += 1 + length
+      if parts[0] == 0:
+        row.append(None)  # zero date, as pymysql returns it
+      elif type == TYPE_DATE:
+        row.append(datetime.date(*parts[0:3]))
+      else:
+        row.append(datetime.datetime(*parts))
+    elif type == TYPE_TIME:
+      length = payload[pos]
+      value = datetime.timedelta()
+      if length >= 8:
+        negative, days, hours, minutes, seconds = struct.unpack_from('<BIBBB', payload, pos + 1)
+        micro = struct.unpack_from('<I', payload, pos + 9)[0] if length >= 12 else 0
+        value = datetime.timedelta(days=days, hours=hours, minutes=minutes, seconds=seconds, microseconds=micro)
+        if negative:
+          value = -value
+      pos += 1 + length
+      row.append(value)
+    else:
+      data, pos = readLenencBytes(payload, pos)
+      if type in (TYPE_DECIMAL, TYPE_NEWDECIMAL):
+        row.append(decimal.Decimal(data.decode('ascii')))
+      elif charset == BINARY_CHARSET:
+        row.append(data)
+      else:
+        row.append(data.decode('utf8'))
+  return tuple(row)
+
+class _Prepare:
+
+  def __init__(self, sql):
+    self.sql = sql
+    self.statement_id = None
+    self.evicted = False
+    self.waiters = []       # (args, deferred) to execute once prepared
+    self.remaining = None
+
+  def packet(self, protocol, payload):
+    if self.remaining is None:
+      if payload[0] == 0xff:
+        self.fail(protocol, parseError(payload))
+        return True
+      statement_id, columns, params = struct.unpack_from('<IHH', payload, 1)
+      self.params = params
+      # parameter and column definitions, each list followed by an EOF
+      self.remaining = (params + 1 if params else 0) + (columns + 1 if columns else 0)
+      self.pending_id = statement_id
+    else:
+      self.remaining -= 1
+    if self.remaining == 0:
+      self.statement_id = self.pending_id
+      waiters, self.waiters = self.waiters, []
+      for args, deferred in waiters:
+        protocol.sendExecute(self, args, deferred)
+      if self.evicted:
+        protocol.closeStatement(self)
+      return True
+    return False
+
+  def fail(self, protocol, error):
+    if protocol.statements.get(self.sql) is self:
+      del protocol.statements[self.sql]
+    waiters, self.waiters = self.waiters, []
+    for args, deferred in waiters:
+      if not deferred.called:
+        deferred.errback(error)
+
+class _Execute:
+
+  def __init__(self, deferred):
+    self.deferred = deferred
+    self.count = None
+    self.columns = []
+    self.rows = []
+    self.in_rows = False
+
+  def fail(self, protocol, error):
+    self.finish(error)
+
+  def finish(self, result):
+    # the caller may have given up (a timeout cancels the deferred);
+    # the response is still read to keep the connection in step
+    if not self.deferred.called:
+      if isinstance(result, Exception):
+        self.deferred.errback(result)
+      else:
+        self.deferred.callback(result)
+
+  def packet(self, protocol, payload):
+    if self.count is None:
+      if payload[0] == 0x00:
+        self.finish([])
+        return True
+      if payload[0] == 0xff:
+        self.finish(parseError(payload))
+        return True
+      self.count = readLenencInt(payload, 0)[0]
+    elif len(self.columns) < self.count:
+      self.columns.append(readColumn(payload))
+    elif not self.in_rows:
+      self.in_rows = True   # EOF after the column definitions
+    elif isEOF(payload):
+      self.finish(self.rows)
+      return True
+    elif payload[0] == 0xff:
+      self.finish(parseError(payload))
+      return True
+    else:
+      self.rows.append(readBinaryRow(payload, self.columns))
+    return False
+
+class _Handshake:
+
+  def __init__(self, user, password, database):
+    self.user = user
+    self.password = password
+    self.database = database
+    self.deferred = defer.Deferred()
+    self.seq = 0
+    self.plugin = None
+
+  def fail(self, protocol, error):
+    if not self.deferred.called:
+      self.deferred.errback(error)
+
+  def packet(self, protocol, payload):
+    if payload[0] == 0xff:
+      self.deferred.errback(parseError(payload))
+      return True
+    if self.plugin is None:
+      self.greeting(protocol, payload)
+      return False
+    if payload[0] == 0x00:
+      self.deferred.callback(protocol)
+      return True
+    if payload[0] == 0xfe:
+      # auth switch: plugin name, then a new scramble
+      end = payload.index(b'\x00', 1)
+      self.plugin = bytes(payload[1:end])
+      self.scramble = bytes(payload[end + 1:]).rstrip(b'\x00')
+      self.respond(protocol, self.authData())
+      return False
+    if payload[0] == 0x01 and payload[1:2] == b'\x03':
+      return False  # caching_sha2 fast auth succeeded; OK follows
+    self.deferred.errback(MySQLError(0, None, "unsupported authentication step %r for %s" % (bytes(payload[:2]), self.plugin.decode('ascii'))))
+    return True
+
+  def greeting(self, protocol, payload):
+    if payload[0] != 10:
+      raise MySQLError(0, None, "unsupported protocol version %d" % payload[0])
+    pos = payload.index(b'\x00', 1) + 1
+    pos += 4  # connection id
+    scramble = bytes(payload[pos:pos + 8])
+    pos += 9
+    caps = struct.unpack_from('<H', payload, pos)[0]
+    pos += 5  # capabilities, charset, status
+    caps |= struct.unpack_from('<H', payload, pos)[0] << 16
+    scramble_len = payload[pos + 2]
+    pos += 13
+    if caps & CLIENT_SECURE_CONNECTION:
+      length = max(13, scramble_len - 8)
+      scramble += bytes(payload[pos:pos + length]).rstrip(b'\x00')
+      pos += length
+    self.plugin = b'mysql_native_password'
+    if caps & CLIENT_PLUGIN_AUTH:
+      end = payload.find(b'\x00', pos)
+      self.plugin = bytes(payload[pos:end if end >= 0 else len(payload)])
+    self.scramble = scramble
+    if not caps & CLIENT_PROTOCOL_41 or not caps & CLIENT_SECURE_CONNECTION:
+      raise MySQLError(0, None, "server does not support the 4.1 protocol")
+    flags = (CLIENT_LONG_PASSWORD | CLIENT_LONG_FLAG | CLIENT_PROTOCOL_41 | CLIENT_TRANSACTIONS | CLIENT_SECURE_CONNECTION | CLIENT_PLUGIN_AUTH) & caps
+    if self.database:
+      flags |= CLIENT_CONNECT_WITH_DB
+    auth = self.authData()
+    response = struct.pack('<IIB23x', flags, MAX_PACKET, UTF8MB4_GENERAL_CI)
+    response += self.user + b'\x00' + bytes((len(auth),)) + auth
+    if self.database:
+      response += self.database + b'\x00'
+    if flags & CLIENT_PLUGIN_AUTH:
+      response += self.plugin + b'\x00'
+    self.respond(protocol, response)
+
+  def authData(self):
+    f = _auth_plugins.get(self.plugin)
+    if f is None:
+      raise MySQLError(0, None, "unsupported authentication plugin %s" % self.plugin.decode('ascii', 'replace'))
+    return f(self.password, self.scramble[:20])
+
+  def respond(self, protocol, payload):
+    protocol.writePacket(payload, protocol.last_seq + 1)
+
+class MySQLProtocol(Protocol):
+
+  def __init__(self, user, password, database, statement_cache=64):
+    self.buffer = bytearray()
+    self.partial = None
+    self.last_seq = 0
+    self.statement_cache = statement_cache
+    self.statements = OrderedDict()   # sql -> _Prepare, least recently used first
+    self.handshake = _Handshake(user, password, database)
+    self.handlers = deque([ self.handshake ])
+    self.ready = self.handshake.deferred
+    self.connected = False
+    self.pool = None
+
+  def connectionMade(self):
+    self.connected = True
+
+  def connectionLost(self, reason):
+    self.connected = False
+    handlers, self.handlers = self.handlers, deque()
+    for handler in handlers:
+      handler.fail(self, MySQLConnectionLost(reason.getErrorMessage()))
+    self.statements.clear()
+    if self.pool is not None:
+      self.pool.connectionLost(self)
+
+  def pending(self):
+    return len(self.handlers)
+
+  def writePacket(self, payload, seq=0):
+    out = []
+    while True:
+      chunk = payload[:MAX_PACKET]
+      payload = payload[MAX_PACKET:]
+      out.append(struct.pack('<I', len(chunk))[:3] + bytes((seq & 0xff,)) + chunk)
+      seq += 1
+      if len(chunk) < MAX_PACKET:
+        break
+    self.transport.writeSequence(out)
+
+  def dataReceived(self, data):
+    buf = self.buffer
+    buf += data
+    offset = 0
+    try:
+      while len(buf) - offset >= 4:
+        header = struct.unpack_from('<I', buf, offset)[0]
+        length = header & 0xffffff
+        if len(buf) - offset < 4 + length:
+          break
+        self.last_seq = header >> 24
+        payload = bytes(buf[offset + 4:offset + 4 + length])
+        offset += 4 + length
+        if length == MAX_PACKET:
+          self.partial = (self.partial or b'') + payload
+          continue
+        if self.partial is not None:
+          payload = self.partial + payload
+          self.partial = None
+        if not self.handlers:
+          log.msg("Unexpected MySQL packet")
+          continue
+        if self.handlers[0].packet(self, payload):
+          self.handlers.popleft()
+    except Exception as e:
+      if self.handlers:
+        self.handlers.popleft().fail(self, e)
+      self.transport.loseConnection()
+    finally:
+      del buf[:offset]
+
+  def prepare(self, sql):
+    statement = self.statements.get(sql)
+    if statement is not None:
+      self.statements.move_to_end(sql)
+      return statement
+    statement = _Prepare(sql)
+    self.handlers.append(statement)
+    self.writePacket(bytes((COM_STMT_PREPARE,)) + sql.encode('utf8'))
+    self.statements[sql] = statement
+    while len(self.statements) > self.statement_cache:
+      old_sql, old = self.statements.popitem(last=False)
+      old.evicted = True
+      if old.statement_id is not None:
+        self.closeStatement(old)
+    return statement
+
+  def closeStatement(self, statement):
+    if self.connected:
+      self.writePacket(struct.pack('<BI', COM_STMT_CLOSE, statement.statement_id))
+
+  def execute(self, sql, args):
+    deferred = defer.Deferred()
+    statement = self.prepare(sql)
+    # statements already prepared are written at once, so commands from
+    # many callers share the connection without waiting on each other
+    if statement.statement_id is not None:
+      self.sendExecute(statement, args, deferred)
+    else:
+      statement.waiters.append((args, deferred))
+    return deferred
+
+  def sendExecute(self, statement, args, deferred):
+    if deferred.called:
+      return
+    if not self.connected:
+      deferred.errback(MySQLConnectionLost("connection closed"))
+    elif len(args) != statement.params:
+      deferred.errback(MySQLError(0, None, "statement takes %d parameters, %d given" % (statement.params, len(args))))
+    else:
+      payload = struct.pack('<BIBI', COM_STMT_EXECUTE, statement.statement_id, 0, 1)
+      if args:
+        payload += encodeParams(args)
+      self.handlers.append(_Execute(deferred))
+      self.writePacket(payload)
+
+  def quit(self):
+    if self.connected:
+      self.writePacket(bytes((COM_QUIT,)))
+      self.transport.loseConnection()
+
+class MySQLConnectionPool:
+
+  # Offers the runQuery/runOperation calls of adbapi.ConnectionPool.
+  # Up to cp_max connections are opened as needed; each request goes to
+  # the connection with the fewest outstanding commands, and another
+  # connection is opened while every existing one is busy. Requests
+  # made before any connection is up wait for one.
+
+  def __init__(self, host='localhost', port=3306, user='', passwd='', db=None, cp_min=1, cp_max=5, connect_timeout=10, statement_cache=64):
+    self.host = host
+    self.port = port
+    self.user = user.encode('utf8') if isinstance(user, str) else user
+    self.passwd = passwd.encode('utf8') if isinstance(passwd, str) else passwd
+    self.db = db.encode('utf8') if isinstance(db, str) else db
+    self.cp_min = cp_min
+    self.cp_max = cp_max
+    self.connect_timeout = connect_timeout
+    self.statement_cache = statement_cache
+    self.connections = []
+    self.connecting = 0
+    self.waiting = deque()
+    self.running = True
+    self.stats = {
+      'queries' : 0,
+      'connects' : 0,
+      'connect_failures' : 0,
+      'max_pipeline' : 0 }
+    reactor.callWhenRunning(self.start)
+    self.shutdownID = reactor.addSystemEventTrigger('during', 'shutdown', self.close)
+
+  def start(self):
+    while len(self.connections) + self.connecting < self.cp_min:
+      self.connect()
+
+  def close(self):
+    self.running = False
+    for connection in list(self.connections):
+      connection.quit()
+    self.connections = []
+    while self.waiting:
+      self.waiting.popleft()[2].errback(MySQLConnectionLost("pool closed"))
+
+  def connect(self):
+    self.connecting += 1
+    protocol = MySQLProtocol(self.user, self.passwd, self.db, self.statement_cache)
+    endpoint = TCP4ClientEndpoint(reactor, self.host, self.port, self.connect_timeout)
+    deferred = connectProtocol(endpoint, protocol)
+    deferred.addCallback(self.handshake)
+    deferred.addCallbacks(self.connected, self.connectFailed)
+
+  def handshake(self, protocol):
+    def failed(failure):
+      protocol.transport.loseConnection()
+      return failure
+    return protocol.ready.addErrback(failed)
+
+  def connected(self, protocol):
+    self.connecting -= 1
+    self.stats['connects'] += 1
+    if not self.running:
+      protocol.quit()
+      return
+    if not protocol.connected:
+      return
+    self.connections.append(protocol)
+    protocol.pool = self
+    while self.waiting and protocol.connected:
+      sql, args, deferred = self.waiting.popleft()
+      protocol.execute(sql, args).chainDeferred(deferred)
+
+  def connectionLost(self, protocol):
+    if protocol in self.connections:
+      self.connections.remove(protocol)
+    if self.running and len(self.connections) + self.connecting < self.cp_min:
+      self.connect()
+
+  def connectFailed(self, failure):
+    self.connecting -= 1
+    self.stats['connect_failures'] += 1
+    log.msg("MySQL connection to %s:%d failed: %s" % (self.host, self.port, failure.getErrorMessage()))
+    if not self.connections and self.connecting == 0:
+      # nothing left to serve the queue; let callers see the failure
+      while self.waiting:
+        self.waiting.popleft()[2].errback(failure)
+
+  def execute(self, sql, args):
+    if not self.running:
+      return defer.fail(MySQLConnectionLost("pool closed"))
+    self.stats['queries'] += 1
+    if args is not None:
+      sql = convertPlaceholders(sql)
+      args = tuple(args)
+    else:
+      args = ()
+    best = min(self.connections, key=MySQLProtocol.pending, default=None)
+    if (best is None or best.pending() > 0) and len(self.connections) + self.connecting < self.cp_max:
+      self.connect()
+    if best is None:
+      deferred = defer.Deferred()
+      self.waiting.append((sql, args, deferred))
+      return deferred
+    if best.pending() + 1 > self.stats['max_pipeline']:
+      self.stats['max_pipeline'] = best.pending() + 1
+    return best.execute(sql, args)
+
+  def logStats(self):
+    s = self.stats
+    log.msg("MySQL pool %s:%d: %d connections, %d queries, %d commands outstanding, %d deepest pipeline, %d connects, %d failed connects" % (self.host, self.port, len(self.connections), s['queries'], sum(c.pending() for c in self.connections) + len(self.waiting), s['max_pipeline'], s['connects'], s['connect_failures']))
+
+  def runQuery(self, sql, args=None):
+    return self.execute(sql, args)
+
+  def runOperation(self, sql, args=None):
+    return self.execute(sql, args).addCallback(lambda rows: None)
+
+  def runInteraction(self, interaction, *args, **kw):
+    raise NotImplementedError("the native MySQL client does not run interactions")
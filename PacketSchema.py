@@ -0,0 +1,173 @@
+# Copyright (C) 2014 and beyond by Jeremiah Morris
+# and contributing developers.
+#
+# This file is part of Metaserver.
+#
+# Metaserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Metaserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import struct
+
+# A packet layout is a list of (name, spec) pairs, in wire order.
+#
+#   'H', 'l', ...  a single big-endian struct value
+#   '3H'           a run of values, unpacked into a list (colors)
+#   '16s'          raw fixed-size bytes
+#   '32z'          fixed-size field holding a null-padded string
+#   '12x'          padding; the name is ignored and should be None
+#   'cstr'         null-terminated string
+#   'rest'         everything up to the end of the packet
+#
+# A name of None on a value field means the value is skipped when
+# unpacking but still expected when packing. Consecutive fixed-size
+# fields are merged into a single struct.Struct, and each layout is
+# compiled once into a pack function and an unpack_into function with
+# the field offsets baked in.
+
+_spec_re = re.compile(r'^(\d*)([xbBhHiIlLqQsz])$')
+
+_FIXED = 0
+_CSTR = 1
+_REST = 2
+
+class Schema:
+
+  def __init__(self, fields):
+    self.fields = fields
+    self._segments = []
+
+    fmt = ''
+    values = []
+    for name, spec in fields:
+      if spec == 'cstr' or spec == 'rest':
+        if fmt:
+          self._segments.append((_FIXED, struct.Struct('>' + fmt), values))
+          fmt, values = '', []
+        self._segments.append((_CSTR if spec == 'cstr' else _REST, name, None))
+        continue
+
+      match = _spec_re.match(spec)
+      if match is None:
+        raise ValueError("bad field spec %r for %r" % (spec, name))
+      count = int(match.group(1) or 1)
+      code = match.group(2)
+      if code == 'x':
+        fmt += spec
+      elif code == 's' or code == 'z':
+        fmt += '%ds' % count
+        values.append((name, 1, code == 'z'))
+      else:
+        fmt += spec
+        values.append((name, count, False))
+    if fmt:
+      self._segments.append((_FIXED, struct.Struct('>' + fmt), values))
+
+    self.unpack_into = self._compileUnpack()
+    self.pack = self._compilePack()
+
+  def _compileUnpack(self):
+    # Generates straight-line code along the lines of
+    #
+    #   def unpack_into(target, data, offset=0):
+    #     target.port, target.remote_server_id = s0(data, offset)
+    #     offset += 4
+    #     if type(data) is memoryview:
+    #       ...
+    #     target.game_data = data[offset:]
+    env = {}
+    lines = [ "def unpack_into(target, data, offset=0):" ]
+    copied = False
+    for i, (kind, a, values) in enumerate(self._segments):
+      if kind == _FIXED:
+        env['s%d' % i] = a.unpack_from
+        targets = []
+        post = []
+        for name, count, strip in values:
+          if name is None:
+            targets += ['_'] * count
+          elif count > 1:
+            temps = [ 'v%d' % (len(targets) + j) for j in range(count) ]
+            targets += temps
+            post.append("  target.%s = [%s]" % (name, ', '.join(temps)))
+          elif strip:
+            temp = 'v%d' % len(targets)
+            targets.append(temp)
+            post.append("  target.%s = %s.rstrip(b'\\x00')" % (name, temp))
+          else:
+            targets.append('target.' + name)
+        if targets:
+          lines.append("  %s, = s%d(data, offset)" % (', '.join(targets), i))
+        else:
+          lines.append("  s%d(data, offset)" % i)
+        lines += post
+        lines.append("  offset += %d" % a.size)
+        continue
+
+      if not copied:
+        # memoryview has no find(); copy out the variable-length tail once
+        lines += [
+          "  if type(data) is memoryview:",
+          "    data = data[offset:].tobytes()",
+          "    offset = 0" ]
+        copied = True
+      target = "target." + a if a is not None else "_"
+      if kind == _REST:
+        lines += [
+          "  %s = data[offset:]" % target,
+          "  offset = len(data)" ]
+      else:
+        lines += [
+          "  nextnull = data.find(b'\\x00', offset)",
+          "  if nextnull < 0:",
+          "    %s = b''" % target,
+          "    offset = len(data)",
+          "  else:",
+          "    %s = data[offset:nextnull]" % target,
+          "    offset = nextnull + 1" ]
+    exec("\n".join(lines), env)
+    return env['unpack_into']
+
+  def _compilePack(self):
+    # Values are passed positionally in field order; list fields take a
+    # sequence and cstr fields take the unterminated bytes. Generates
+    #
+    #   def pack(a0, a1, a2):
+    #     return s0(a0, a1[0], a1[1], a1[2]) + a2 + b'\x00'
+    env = {}
+    args = []
+    parts = []
+    for i, (kind, a, values) in enumerate(self._segments):
+      if kind == _FIXED:
+        env['s%d' % i] = a.pack
+        items = []
+        for name, count, strip in values:
+          arg = 'a%d' % len(args)
+          args.append(arg)
+          if count > 1:
+            items += ['%s[%d]' % (arg, j) for j in range(count)]
+          else:
+            items.append(arg)
+        parts.append("s%d(%s)" % (i, ', '.join(items)))
+      else:
+        arg = 'a%d' % len(args)
+        args.append(arg)
+        parts.append(arg)
+        if kind == _CSTR:
+          parts.append("b'\\x00'")
+    if len(parts) == 1:
+      body = parts[0]
+    else:
+      body = "b''.join((%s))" % ', '.join(parts)
+    exec("def pack(%s):\n  return %s" % (', '.join(args), body), env)
+    return env['pack']
@@ -0,0 +1,128 @@
+# Copyright (C) 2014 and beyond by Jeremiah Morris
+# and contributing developers.
+#
+# This file is part of Metaserver.
+#
+# Metaserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Metaserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.application import service
+from twisted.internet import reactor, defer
+from twisted.python import log
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import bcrypt
+import time
+
+def checkPassword(password, hashed):
+  # runs in a worker; must stay a module-level function so process
+  # workers can unpickle it
+  start = time.perf_counter()
+  match = bcrypt.checkpw(password, hashed)
+  return match, time.perf_counter() - start
+
+class VerifierBusy(Exception):
+  pass
+
+class PasswordVerifier(service.Service):
+
+  # bcrypt runs in a bounded pool of threads (bcrypt releases the GIL
+  # while hashing) or processes, so password checks never hold up the
+  # reactor. At most max_queue checks may be waiting or running; past
+  # that verify() fails with VerifierBusy.
+
+  def __init__(self, mode='thread', workers=2, max_queue=32):
+    if mode not in ('thread', 'process'):
+      raise ValueError("bcrypt_mode must be 'thread' or 'process', not %r" % mode)
+    self.mode = mode
+    self.workers = workers
+    self.max_queue = max_queue
+    self.pending = 0
+    self.futures = set()
+    self.executor = None
+    self.stats = {
+      'checked' : 0,
+      'rejected' : 0,
+      'busy' : 0,
+      'cancelled' : 0,
+      'errors' : 0,
+      'max_pending' : 0,
+      'hash_time' : 0.0,
+      'wait_time' : 0.0,
+      'max_latency' : 0.0 }
+
+  def startService(self):
+    service.Service.startService(self)
+    self.startExecutor()
+
+  def stopService(self):
+    service.Service.stopService(self)
+    if self.executor is not None:
+      # checks still queued are dropped; shutdown(cancel_futures=True)
+      # would do this, but needs Python 3.9
+      for future in list(self.futures):
+        future.cancel()
+      self.executor.shutdown(wait=False)
+      self.executor = None
+    self.logStats()
+
+  def startExecutor(self):
+    if self.executor is None:
+      if self.mode == 'process':
+        self.executor = ProcessPoolExecutor(self.workers)
+      else:
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='bcrypt')
+
+  def verify(self, password, hashed):
+    if self.pending >= self.max_queue:
+      self.stats['busy'] += 1
+      return defer.fail(VerifierBusy("%d password checks pending" % self.pending))
+    self.startExecutor()
+    future = self.executor.submit(checkPassword, password, hashed)
+    self.pending += 1
+    self.futures.add(future)
+    if self.pending > self.stats['max_pending']:
+      self.stats['max_pending'] = self.pending
+    d = defer.Deferred(lambda d: future.cancel())
+    queued = time.perf_counter()
+    future.add_done_callback(lambda f: reactor.callFromThread(self.checkDone, d, f, queued))
+    return d
+
+  def checkDone(self, d, future, queued):
+    self.pending -= 1
+    self.futures.discard(future)
+    if future.cancelled():
+      self.stats['cancelled'] += 1
+      return
+    exc = future.exception()
+    if exc is not None:
+      self.stats['errors'] += 1
+      if not d.called:
+        d.errback(exc)
+      return
+    match, elapsed = future.result()
+    latency = time.perf_counter() - queued
+    self.stats['checked'] += 1
+    if not match:
+      self.stats['rejected'] += 1
+    self.stats['hash_time'] += elapsed
+    self.stats['wait_time'] += max(latency - elapsed, 0.0)
+    if latency > self.stats['max_latency']:
+      self.stats['max_latency'] = latency
+    if not d.called:
+      d.callback(match)
+
+  def logStats(self):
+    s = self.stats
+    if s['checked'] > 0:
+      log.msg("%d password checks (%d rejected): %.1f ms hashing, %.1f ms waiting on average, %.1f ms worst" % (s['checked'], s['rejected'], 1000 * s['hash_time'] / s['checked'], 1000 * s['wait_time'] / s['checked'], 1000 * s['max_latency']))
+    log.msg("%d password checks pending (%d at most), %d refused busy, %d cancelled, %d errors" % (self.pending, s['max_pending'], s['busy'], s['cancelled'], s['errors']))
@@ -4,8 +4,21 @@
 ## Copyright (C) 2009 by Jeffrey Galens
 
 from twisted.enterprise import adbapi
+from twisted.internet import task, threads
 from twisted.python import log
 import pymysql
+import re
+import threading
+import time
+
+_label_re = re.compile(r'\s*(\w+)\s+(?:.*?\b(?:FROM|INTO)\s+)?`?(\w+)', re.IGNORECASE | re.DOTALL)
+
+def queryLabel(sql):
+    """Short name for a statement, e.g. "SELECT user", used to group stats."""
+    m = _label_re.match(sql)
+    if m is not None:
+        return "%s %s" % (m.group(1).upper(), m.group(2))
+    return sql.split(None, 1)[0].upper() if sql.strip() else '?'
 
 class ReconnectingConnectionPool(adbapi.ConnectionPool):
     """Reconnecting adbapi connection pool for MySQL.
@@ -18,7 +31,153 @@ class ReconnectingConnectionPool(adbapi.ConnectionPool):
     Also see:
     http://twistedmatrix.com/pipermail/twisted-python/2009-July/020007.html
 
+    Each call is timed: the wait for a pool thread and the time spent in
+    the database are recorded per query label, along with errors. At
+    startup cp_min connections are opened before any query needs them.
+    After a failed connect, further connects fail at once with the same
+    error until a backoff delay has passed; the delay doubles with each
+    failure up to cp_backoff_max seconds and resets on success.
+
+    The thread count starts at cp_min. Every cp_adjust_interval seconds
+    it grows by one, up to cp_max, if at least a tenth of the calls in
+    that period waited longer than cp_grow_wait_ms for a thread, and
+    shrinks by one, down to cp_min, if no call waited that long and
+    fewer threads than the current limit were ever busy at once. A
+    cp_adjust_interval of 0 keeps cp_max threads, as adbapi does.
     """
+
+    def __init__(self, *args, **kw):
+        self.adjust_interval = kw.pop('cp_adjust_interval', 10)
+        self.grow_wait = kw.pop('cp_grow_wait_ms', 20) / 1000.0
+        self.backoff_max = kw.pop('cp_backoff_max', 30)
+        adbapi.ConnectionPool.__init__(self, *args, **kw)
+        self.limit = self.min if self.adjust_interval else self.max
+        self.threadpool.adjustPoolsize(maxthreads=self.limit)
+        self.lock = threading.Lock()
+        self.labels = {}        # label -> [calls, errors, wait, max wait, exec, max exec]
+        self.period = [0, 0, 0] # calls, slow waits, most busy threads this period
+        self.busy = 0
+        self.backoff = 0
+        self.next_connect = 0
+        self.connect_error = None
+        self.adjuster = None
+        self.stats = {
+            'connects' : 0,
+            'connect_failures' : 0,
+            'fast_failures' : 0,
+            'retries' : 0,
+            'grown' : 0,
+            'shrunk' : 0 }
+
+    def start(self):
+        if self.running:
+            return
+        adbapi.ConnectionPool.start(self)
+        # one task per thread: the barrier keeps each on its own thread
+        # (a Barrier needs at least one party, and cp_min may be 0)
+        if self.min > 0:
+            barrier = threading.Barrier(self.min)
+            for i in range(self.min):
+                self.threadpool.callInThread(self._preopen, barrier)
+        if self.adjust_interval:
+            self.adjuster = task.LoopingCall(self.adjust)
+            self.adjuster.clock = self._reactor
+            self.adjuster.start(self.adjust_interval, now=False)
+
+    def _preopen(self, barrier):
+        try:
+            self.connect()
+        except Exception as e:
+            log.msg("RCP: could not open connection at startup: %s" % e)
+        try:
+            barrier.wait(10)
+        except threading.BrokenBarrierError:
+            pass
+
+    def finalClose(self):
+        if self.adjuster is not None and self.adjuster.running:
+            self.adjuster.stop()
+        self.adjuster = None
+        adbapi.ConnectionPool.finalClose(self)
+
+    def connect(self):
+        # self.connections is shared with adjust(), which prunes it from
+        # the reactor thread, so it is only touched under self.lock
+        tid = self.threadID()
+        with self.lock:
+            conn = self.connections.get(tid)
+            if conn is not None:
+                return conn
+            if time.monotonic() < self.next_connect:
+                self.stats['fast_failures'] += 1
+                raise pymysql.OperationalError(*self.connect_error.args)
+        try:
+            conn = self.dbapi.connect(*self.connargs, **self.connkw)
+            if self.openfun is not None:
+                self.openfun(conn)
+        except pymysql.Error as e:
+            with self.lock:
+                self.stats['connect_failures'] += 1
+                self.backoff = min(max(self.backoff * 2, 0.5), self.backoff_max)
+                self.next_connect = time.monotonic() + self.backoff
+                self.connect_error = e
+            log.msg("RCP: connect failed, next attempt in %.1f s: %s" % (self.backoff, e))
+            raise
+        with self.lock:
+            self.stats['connects'] += 1
+            self.backoff = 0
+            self.next_connect = 0
+            self.connections[tid] = conn
+        return conn
+
+    def disconnect(self, conn):
+        tid = self.threadID()
+        with self.lock:
+            if conn is not self.connections.get(tid):
+                raise Exception("wrong connection for thread")
+            if conn is None:
+                return
+            del self.connections[tid]
+        self._close(conn)
+
+    def runInteraction(self, interaction, *args, **kw):
+        if interaction in (self._runQuery, self._runOperation) and args:
+            label = queryLabel(args[0])
+        else:
+            label = getattr(interaction, '__name__', 'interaction')
+        return threads.deferToThreadPool(self._reactor, self.threadpool,
+                                         self._timedInteraction, label, time.monotonic(),
+                                         interaction, *args, **kw)
+
+    def _timedInteraction(self, label, queued, interaction, *args, **kw):
+        started = time.monotonic()
+        wait = started - queued
+        with self.lock:
+            self.busy += 1
+            self.period[0] += 1
+            if wait > self.grow_wait:
+                self.period[1] += 1
+            if self.busy > self.period[2]:
+                self.period[2] = self.busy
+        failed = True
+        try:
+            result = self._runInteraction(interaction, *args, **kw)
+            failed = False
+            return result
+        finally:
+            elapsed = time.monotonic() - started
+            with self.lock:
+                self.busy -= 1
+                s = self.labels.get(label)
+                if s is None:
+                    s = self.labels[label] = [0, 0, 0.0, 0.0, 0.0, 0.0]
+                s[0] += 1
+                s[1] += failed
+                s[2] += wait
+                s[3] = max(s[3], wait)
+                s[4] += elapsed
+                s[5] = max(s[5], elapsed)
+
     def _runInteraction(self, interaction, *args, **kw):
         try:
             return adbapi.ConnectionPool._runInteraction(self, interaction, *args, **kw)
@@ -29,7 +188,43 @@ class ReconnectingConnectionPool(adbapi.ConnectionPool):
             if e.args[0] not in (1927, 2006, 2013):
                 raise
             log.msg("RCP: got error %s, retrying operation" %(e))
-            conn = self.connections.get(self.threadID())
+            with self.lock:
+                self.stats['retries'] += 1
+            with self.lock:
+                conn = self.connections.get(self.threadID())
             self.disconnect(conn)
             # try the interaction again
             return adbapi.ConnectionPool._runInteraction(self, interaction, *args, **kw)
+
+    def adjust(self):
+        with self.lock:
+            calls, slow, peak = self.period
+            self.period = [0, 0, self.busy]
+        limit = self.limit
+        if calls and slow * 10 >= calls and limit < self.max:
+            limit += 1
+            self.stats['grown'] += 1
+        elif slow == 0 and peak < limit and limit > self.min:
+            limit -= 1
+            self.stats['shrunk'] += 1
+        if limit != self.limit:
+            log.msg("RCP: %d threads (was %d); %d calls, %d waited over %d ms, at most %d busy"
+                    % (limit, self.limit, calls, slow, self.grow_wait * 1000, peak))
+            self.limit = limit
+            self.threadpool.adjustPoolsize(maxthreads=limit)
+        # connections belonging to threads that have since exited
+        live = set(t.ident for t in threading.enumerate())
+        with self.lock:
+            stale = [ self.connections.pop(tid) for tid in list(self.connections) if tid not in live ]
+        for conn in stale:
+            self._close(conn)
+
+    def logStats(self):
+        s = self.stats
+        log.msg("RCP: %d of %d-%d threads, %d connections, %d busy; %d connects, %d failed, %d refused during backoff, %d retries, grown %d, shrunk %d times"
+                % (self.limit, self.min, self.max, len(self.connections), self.busy, s['connects'], s['connect_failures'], s['fast_failures'], s['retries'], s['grown'], s['shrunk']))
+        with self.lock:
+            labels = sorted(self.labels.items(), key=lambda item: -item[1][4])
+        for label, (calls, errors, wait, max_wait, elapsed, max_elapsed) in labels:
+            log.msg("RCP: %s: %d calls, %d errors, wait %.1f ms average / %.1f ms worst, run %.1f ms average / %.1f ms worst"
+                    % (label, calls, errors, 1000 * wait / calls, 1000 * max_wait, 1000 * elapsed / calls, 1000 * max_elapsed))
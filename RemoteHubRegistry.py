@@ -0,0 +1,153 @@
+# Copyright (C) 2014 and beyond by Jeremiah Morris
+# and contributing developers.
+#
+# This file is part of Metaserver.
+#
+# Metaserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Metaserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.application import service
+from twisted.internet import reactor, defer, task
+from twisted.python import log
+from MetaPackets import RemoteHubListPacket
+
+class RemoteHubRegistry(service.Service):
+
+  # Holds the remotehub table in memory, reloading it every
+  # refresh_interval seconds, and tracks which game occupies each hub.
+  # The free hub list sent to gatherers is built once per network
+  # version and reused until a game claims or releases a hub, the table
+  # changes, or a hub's address changes in the resolver.
+
+  def __init__(self, storage, resolver, refresh_interval=60):
+    self.storage = storage
+    self.resolver = resolver
+    self.refresh_interval = refresh_interval
+    self.hubs = {}          # hub id -> (network version, host, port)
+    self.versions = {}      # network version -> hub ids
+    self.occupied = {}      # hub id -> game id
+    self.lists = {}         # network version -> (resolver generation, packet)
+    self.waiters = None     # Deferreds for callers of a load in progress
+    self.loaded = False
+    self.refresher = None
+    self.stats = {
+      'hits' : 0,
+      'builds' : 0,
+      'loads' : 0 }
+
+  def startService(self):
+    service.Service.startService(self)
+    self.refresher = task.LoopingCall(self.load)
+    self.refresher.clock = reactor
+    self.refresher.start(self.refresh_interval, now=True)
+
+  def stopService(self):
+    service.Service.stopService(self)
+    if self.refresher is not None and self.refresher.running:
+      self.refresher.stop()
+    self.refresher = None
+
+  def load(self):
+    # each caller gets its own Deferred, fired with None once the load
+    # in progress finishes; a shared one would hand every caller the
+    # result of the callbacks added before its own
+    deferred = defer.Deferred()
+    if self.waiters is not None:
+      self.waiters.append(deferred)
+      return deferred
+    self.waiters = [deferred]
+    loading = self.storage.remoteHubs()
+    loading.addCallbacks(self.loadResult, self.loadFailure)
+    loading.addCallback(self.loadDone)
+    return deferred
+
+  def loadDone(self, _):
+    waiters, self.waiters = self.waiters, None
+    for deferred in waiters:
+      deferred.callback(None)
+
+  def loadResult(self, rs):
+    hubs = dict((row[0], (row[1], row[2], row[3])) for row in rs)
+    self.stats['loads'] += 1
+    self.loaded = True
+    if hubs == self.hubs:
+      return
+    self.hubs = hubs
+    self.versions = {}
+    for hub_id in sorted(hubs):
+      self.versions.setdefault(hubs[hub_id][0], []).append(hub_id)
+    self.lists = {}
+    log.msg("Loaded %d remote hubs" % len(hubs))
+    self.resolver.pin(hub[1] for hub in hubs.values())
+
+  def loadFailure(self, failure):
+    log.msg("Remote hub load failure: %s" % str(failure))
+
+  def hub(self, hub_id):
+    # (network version, host, port), or None for an unknown hub
+    return self.hubs.get(hub_id)
+
+  def occupant(self, hub_id):
+    return self.occupied.get(hub_id)
+
+  def claim(self, hub_id, game_id):
+    current = self.occupied.get(hub_id)
+    if current is not None:
+      return current == game_id
+    self.occupied[hub_id] = game_id
+    self.invalidate(hub_id)
+    return True
+
+  def release(self, hub_id, game_id):
+    if hub_id is not None and self.occupied.get(hub_id) == game_id:
+      del self.occupied[hub_id]
+      self.invalidate(hub_id)
+
+  def invalidate(self, hub_id):
+    hub = self.hubs.get(hub_id)
+    if hub is not None:
+      self.lists.pop(hub[0], None)
+
+  def hubList(self, network_version):
+    # fires with a RemoteHubListPacket of the free hubs for this version
+    if isinstance(network_version, bytes):
+      network_version = network_version.decode('mac_roman')
+    if not self.loaded:
+      return self.load().addCallback(lambda _: self.hubList(network_version) if self.loaded else RemoteHubListPacket([]))
+    cached = self.lists.get(network_version)
+    if cached is not None and cached[0] == self.resolver.generation:
+      self.stats['hits'] += 1
+      return defer.succeed(cached[1])
+    free = [ hub_id for hub_id in self.versions.get(network_version, ()) if hub_id not in self.occupied ]
+    generation = self.resolver.generation
+    deferred = defer.gatherResults([ self.resolver.lookup(self.hubs[hub_id][1]) for hub_id in free ])
+    deferred.addCallback(self.buildList, network_version, free, generation)
+    return deferred
+
+  def buildList(self, addresses, network_version, free, generation):
+    remote_servers = []
+    for hub_id, ipaddress in zip(free, addresses):
+      if ipaddress is None:
+        log.msg("Can't resolve remote hub address from host %s" % self.hubs[hub_id][1])
+        continue
+      remote_servers.append((hub_id, ipaddress, self.hubs[hub_id][2]))
+    packet = RemoteHubListPacket(remote_servers)
+    self.stats['builds'] += 1
+    # only keep the list if nothing it depends on changed meanwhile
+    if generation == self.resolver.generation and free == [ hub_id for hub_id in self.versions.get(network_version, ()) if hub_id not in self.occupied ]:
+      self.lists[network_version] = (generation, packet)
+    return packet
+
+  def logStats(self):
+    s = self.stats
+    log.msg("%d remote hubs (%d occupied): %d lists built, %d reused, %d loads" % (len(self.hubs), len(self.occupied), s['builds'], s['hits'], s['loads']))
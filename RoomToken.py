@@ -0,0 +1,161 @@
+# Copyright (C) 2014 and beyond by Jeremiah Morris
+# and contributing developers.
+#
+# This file is part of Metaserver.
+#
+# Metaserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Metaserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import reactor
+from twisted.python import log
+from collections import deque
+import base64
+import binascii
+import hashlib
+import hmac
+import struct
+
+# A signed token is 24 bytes, base64 encoded (URL-safe alphabet) to
+# the 32 printable characters LoginSuccessfulPacket carries:
+#
+#   user_id      2 bytes
+#   expires      4 bytes, Unix time
+#   flags        1 byte: the FLAG_ bits, and a counter in the high
+#                nibble so tokens issued together still differ
+#   sort_order   4 bytes, signed
+#   name hash    5 bytes, keyed hash of the username (empty for guests)
+#   mac          8 bytes, truncated HMAC-SHA256 of the above
+#
+# All integers are big-endian.
+
+_claims = struct.Struct('>HLBl5s')
+MAC_SIZE = 8
+
+FLAG_MODERATOR = 0x01
+FLAG_HIDDEN = 0x02
+FLAG_SORTED = 0x04
+FLAG_REGISTERED = 0x08
+
+class RoomTokenClaims:
+
+  # What a verified token says about its user. username is None for
+  # guests.
+
+  def __init__(self, user_id, expires, flags, sort_order, username):
+    self.user_id = user_id
+    self.expires = expires
+    self.username = username
+    self.moderator = bool(flags & FLAG_MODERATOR)
+    self.visible = not (flags & FLAG_HIDDEN)
+    self.sort_order = sort_order if flags & FLAG_SORTED else None
+
+class RoomTokenSigner:
+
+  # Issues and checks room login tokens signed with secret, so roomd
+  # can accept a login without asking userd. A token is good for
+  # lifetime seconds and only once: the MACs of redeemed tokens are
+  # kept until the tokens expire, and while replay_max of them are
+  # held further tokens are refused rather than risk a replay.
+
+  def __init__(self, secret, lifetime=30, replay_max=100000):
+    if isinstance(secret, str):
+      secret = secret.encode('utf8')
+    self.key = hashlib.sha256(b'metaserver room token\0' + secret).digest()
+    self.lifetime = lifetime
+    self.replay_max = replay_max
+    self.counter = 0
+    self.used = {}            # mac -> expires
+    self.used_order = deque() # (expires, mac), in order of redemption
+    self.stats = {
+      'issued' : 0,
+      'accepted' : 0,
+      'malformed' : 0,
+      'forged' : 0,
+      'expired' : 0,
+      'wrong_user' : 0,
+      'replayed' : 0,
+      'cache_full' : 0 }
+
+  def nameHash(self, username):
+    if not username:
+      return b'\0' * 5
+    return hmac.new(self.key, b'name\0' + username, hashlib.sha256).digest()[:5]
+
+  def mac(self, claims):
+    return hmac.new(self.key, claims, hashlib.sha256).digest()[:MAC_SIZE]
+
+  def issue(self, user_id, username=None, moderator=False, visible=True, sort_order=None):
+    self.counter = (self.counter + 1) & 0x0f
+    flags = self.counter << 4
+    if moderator:
+      flags |= FLAG_MODERATOR
+    if not visible:
+      flags |= FLAG_HIDDEN
+    if sort_order is not None:
+      flags |= FLAG_SORTED
+    if username:
+      flags |= FLAG_REGISTERED
+    claims = _claims.pack(user_id, int(reactor.seconds()) + self.lifetime, flags, sort_order or 0, self.nameHash(username))
+    self.stats['issued'] += 1
+    return base64.urlsafe_b64encode(claims + self.mac(claims))
+
+  def redeem(self, token, username):
+    # RoomTokenClaims if token is genuine, unexpired, unused and was
+    # issued to username (b'guest' or b'' for a guest), else None
+    try:
+      raw = base64.urlsafe_b64decode(bytes(token)) if len(token) == 32 else b''
+    except (binascii.Error, ValueError):
+      raw = b''
+    if len(raw) != _claims.size + MAC_SIZE:
+      self.stats['malformed'] += 1
+      return None
+    claims, mac = raw[:_claims.size], raw[_claims.size:]
+    if not hmac.compare_digest(mac, self.mac(claims)):
+      self.stats['forged'] += 1
+      return None
+    user_id, expires, flags, sort_order, name_hash = _claims.unpack(claims)
+    now = reactor.seconds()
+    if expires <= now:
+      self.stats['expired'] += 1
+      return None
+    if username == b'guest':
+      username = b''
+    if bool(flags & FLAG_REGISTERED) != bool(username) or not hmac.compare_digest(name_hash, self.nameHash(username)):
+      self.stats['wrong_user'] += 1
+      return None
+    self.forget(now)
+    if mac in self.used:
+      self.stats['replayed'] += 1
+      return None
+    if len(self.used) >= self.replay_max:
+      self.stats['cache_full'] += 1
+      return None
+    self.used[mac] = expires
+    self.used_order.append((expires, mac))
+    self.stats['accepted'] += 1
+    return RoomTokenClaims(user_id, expires, flags, sort_order, username or None)
+
+  def forget(self, now):
+    # entries go in as tokens are redeemed, close to expiry order; one
+    # that expires later than those behind it only holds them until it
+    # expires too
+    order = self.used_order
+    while order and order[0][0] <= now:
+      expires, mac = order.popleft()
+      if self.used.get(mac) == expires:
+        del self.used[mac]
+
+  def logStats(self):
+    s = self.stats
+    log.msg("Room tokens: %d issued, %d accepted, %d malformed, %d forged, %d expired, %d for another user, %d replayed, %d refused with a full cache; %d held against replay"
+            % (s['issued'], s['accepted'], s['malformed'], s['forged'], s['expired'], s['wrong_user'], s['replayed'], s['cache_full'], len(self.used)))
@@ -17,10 +17,11 @@
 # along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
 
 from twisted.internet.protocol import Factory
+from twisted.internet import reactor
 from twisted.python import log
 from MetaProtocol import MetaProtocol
 from MetaPackets import *
-from UserInfo import UserInfo
+from UserInfo import UserInfo, RoomRoster
 from GameTester import GameTester
 import pprint
 import time
@@ -34,6 +35,18 @@ class Roomd(MetaProtocol):
   VERB_DELETE = 1
   VERB_CHANGE = 2
   
+  _recv_packets = [
+    (RoomLoginPacket, 'handleRoomLoginPacket', [NEED_LOGIN]),
+    (PlayerDataPacket, 'handlePlayerDataPacket', [NEED_PLAYER_DATA]),
+    (PlayerModePacket, 'handlePlayerModePacket', [LOGGED_IN]),
+    (CreateGamePacket, 'handleCreateGamePacket', [LOGGED_IN]),
+    (StartGamePacket, 'handleStartGamePacket', [LOGGED_IN]),
+    (RemoveGamePacket, 'handleRemoveGamePacket', [LOGGED_IN]),
+    (IncomingChatPacket, 'handleIncomingChatPacket', [LOGGED_IN]),
+    (IncomingPrivateMessagePacket, 'handleIncomingPrivateMessagePacket', [LOGGED_IN]),
+    (LogoutPacket, 'handleLogoutPacket', None),
+    (IncomingKeepAlivePacket, None, None) ]
+  
   def __init__(self, factory):
     MetaProtocol.__init__(self)
     self.factory = factory
@@ -45,7 +58,12 @@ class Roomd(MetaProtocol):
     self.user_info = None
     self.game_info = None
     self.tester = None
-    self.dbpool = self.userd.dbpool
+    self.resume_credential = None
+    self.resumable = False
+    self.resuming = False
+    self.resume_call = None
+    self._pending_players = {}
+    self.logwriter = self.userd.logwriter
     self.log_events = True if self.factory.options['log_events'] > 0 else False
     self.log_logindetail = True if self.factory.options['log_logindetail'] > 0 else False
     self.log_chat = True if self.factory.options['log_chat'] > 0 else False
@@ -53,31 +71,21 @@ class Roomd(MetaProtocol):
     if not self.log_chat:
       self.log_pm = False
   
-  def packetReceived(self, packet):
-    if isinstance(packet, RoomLoginPacket):
-      return self.handleRoomLoginPacket(packet)
-    if isinstance(packet, PlayerDataPacket):
-      return self.handlePlayerDataPacket(packet)
-    if isinstance(packet, PlayerModePacket):
-      return self.handlePlayerModePacket(packet)
-    if isinstance(packet, CreateGamePacket):
-      return self.handleCreateGamePacket(packet)
-    if isinstance(packet, StartGamePacket):
-      return self.handleStartGamePacket(packet)
-    if isinstance(packet, RemoveGamePacket):
-      return self.handleRemoveGamePacket(packet)
-    if isinstance(packet, IncomingChatPacket):
-      return self.handleIncomingChatPacket(packet)
-    if isinstance(packet, IncomingPrivateMessagePacket):
-      return self.handleIncomingPrivateMessagePacket(packet)
-    if isinstance(packet, LogoutPacket):
-      return self.handleLogoutPacket(packet)
-    return False
+  def packetRejected(self, code):
+    if code == RoomLoginPacket.code or (code == PlayerDataPacket.code and self.state != self.NEED_LOGIN):
+      self.sendMessage(MessagePacket.USER_LOGGED_IN)
+    else:
+      self.sendMessage(MessagePacket.NOT_LOGGED_IN)
       
   def handleRoomLoginPacket(self, packet):
-    if self.state != self.NEED_LOGIN:
-      self.sendMessage(MessagePacket.USER_LOGGED_IN)
-      return False
+    # the token the client logged in with also resumes its session if
+    # the connection dropped a moment ago
+    self.resume_credential = bytes(packet.token)
+    held = self.factory.resume(self.resume_credential, packet.username)
+    if held is not None:
+      return self.resumeSession(held)
+    if self.factory.signer is not None:
+      return self.signedRoomLogin(packet)
     self.user_id = self.userd.redeemToken(packet.token)
     if self.user_id is None:
       self.sendMessage(MessagePacket.NOT_LOGGED_IN)
@@ -96,21 +104,91 @@ class Roomd(MetaProtocol):
     self.user_info.roomd_connection = self
     return True
   
+  def signedRoomLogin(self, packet):
+    # The token itself vouches for the user. If userd runs in this
+    # process and still has the user, that record is picked up and its
+    # own token released; otherwise the user is built from the token.
+    claims = self.factory.signer.redeem(packet.token, packet.username)
+    if claims is None:
+      self.sendMessage(MessagePacket.NOT_LOGGED_IN)
+      return False
+    uinfo = self.globals['users'].get(claims.user_id)
+    if uinfo is not None:
+      if uinfo.username != claims.username:
+        self.sendMessage(MessagePacket.BAD_USER)
+        return False
+      if uinfo.token is not None:
+        self.userd.redeemToken(uinfo.token)
+    else:
+      if claims.username is not None:
+        if claims.username in self.globals['usernames']:
+          self.sendMessage(MessagePacket.USER_LOGGED_IN)
+          return False
+        self.globals['usernames'][claims.username] = claims.user_id
+      uinfo = UserInfo(claims.user_id, None, None)
+      uinfo.username = claims.username
+      uinfo.visible = claims.visible
+      uinfo.moderator = claims.moderator
+      uinfo.sort_id = claims.sort_order
+      self.globals['users'][claims.user_id] = uinfo
+    self.user_id = claims.user_id
+    self.user_info = uinfo
+    self.state = self.NEED_PLAYER_DATA
+    uinfo.roomd_connection = self
+    return True
+  
+  def resumeSession(self, held):
+    log.msg("resuming session of user %d" % held.user_id)
+    self.user_id = held.user_id
+    self.user_info = held.user_info
+    self.game_info = held.game_info
+    self.user_info.roomd_connection = self
+    self.resuming = True
+    self.resumable = True
+    self.state = self.NEED_PLAYER_DATA
+    return True
+  
+  def finishResume(self):
+    # The rest of the room never saw the user leave; only a change in
+    # game status is news to them. The client starts over with the
+    # room's player and game lists.
+    self.resuming = False
+    self.resumable = True
+    self.state = self.LOGGED_IN
+    changed = self.user_info.in_game
+    self.deaf = False
+    self.user_info.in_game = False
+    self.updateMembership()
+    self.sendPacket(RoomLoginSuccessfulPacket(self.user_id))
+    self.sendMessage(MessagePacket.LOGIN_SUCCESSFUL)
+    if changed:
+      self.sendPlayerList(self.user_id, 0 - self.user_id, self.VERB_CHANGE)
+    self.sendPlayerList(0, self.user_id, self.VERB_ADD)
+    self.sendGameList(0, self.user_id, self.VERB_ADD)
+    return True
+  
   def handlePlayerDataPacket(self, packet):
-    if self.state != self.NEED_PLAYER_DATA:
-      if self.state == self.NEED_LOGIN:
-        self.sendMessage(MessagePacket.NOT_LOGGED_IN)
+    if self.resuming:
+      return self.finishResume()
+    if self.user_info.player_info is None:
+      # built from a signed token; the room's player data stands in for
+      # what userd got at login, less the build details
+      packet.build_date = packet.build_time = b''
+      packet.platform_type = 0
+      self.user_info.set_player_info(packet)
+      if self.user_info.username is None:
+        self.user_info.chatname = b'|iGuest|p ' + packet.player_name
       else:
-        self.sendMessage(MessagePacket.USER_LOGGED_IN)
-      return False
-    
-    # we actually ignore the data; we kept it from userd
+        self.user_info.chatname = packet.player_name
+    # otherwise we ignore the data; we kept it from userd
     # just log them in
     self.logEvent('login', pprint.pformat(vars(self.user_info.player_info)))
     self.logLogin()
     self.state = self.LOGGED_IN
+    self.resumable = True
     self.deaf = False
     self.user_info.in_game = False
+    self.updateMembership()
     self.sendPacket(RoomLoginSuccessfulPacket(self.user_id))
     self.sendMessage(MessagePacket.LOGIN_SUCCESSFUL)
     
@@ -131,15 +209,13 @@ class Roomd(MetaProtocol):
     return True
   
   def handlePlayerModePacket(self, packet):
-    if self.state != self.LOGGED_IN:
-      self.sendMessage(MessagePacket.NOT_LOGGED_IN)
-      return False
     go_deaf = False
     if packet.deaf > 0:
       go_deaf = True
     if self.deaf != go_deaf:
       self.deaf = go_deaf
       self.user_info.in_game = True
+      self.updateMembership()
       if go_deaf:
         self.logEvent('enter game', packet.session_id.hex())
       else:
@@ -149,10 +225,6 @@ class Roomd(MetaProtocol):
     return True
   
   def handleCreateGamePacket(self, packet):
-    if self.state != self.LOGGED_IN:
-      self.sendMessage(MessagePacket.NOT_LOGGED_IN)
-      return False
-      
     self.logEvent('create game', packet.game_data.hex())
     verb = self.VERB_CHANGE
     if self.game_info is None:
@@ -164,12 +236,22 @@ class Roomd(MetaProtocol):
     self.game_info.port = packet.port
     self.game_info.game_data = packet.game_data
 
+    remote_hubs = self.userd.remote_hubs
+    if self.game_info.remote_hub_id is not None and self.game_info.remote_hub_id != packet.remote_server_id:
+      remote_hubs.release(self.game_info.remote_hub_id, self.game_info.game_id)
+      self.game_info.remote_hub_id = None
+      self.game_info.host = self.transport.getPeer().host
     if packet.remote_server_id > 0:
-      if any(game.remote_hub_id == packet.remote_server_id and game.game_id != self.game_info.game_id for game in self.globals['games'].values()):
+      hub = remote_hubs.hub(packet.remote_server_id)
+      if hub is None:
+        log.msg("Remote hub id %d is not registered" % packet.remote_server_id)
+        return False
+      if not remote_hubs.claim(packet.remote_server_id, self.game_info.game_id):
         log.msg("Unexpected situation detected. Found another advertised game already using the requested remote hub id %d" % packet.remote_server_id)
         return False
-      deferred = self.dbpool.runQuery("SELECT host, port FROM remotehub WHERE id = %s", (packet.remote_server_id, ))
-      deferred.addCallback(lambda result: self.remoteCreateGameResult(result, packet.remote_server_id, verb))
+      self.game_info.remote_hub_id = packet.remote_server_id
+      deferred = self.userd.resolver.lookup(hub[1])
+      deferred.addCallback(self.remoteCreateGameResolved, hub[1], hub[2], packet.remote_server_id, verb)
       deferred.addErrback(self.remoteCreateGameFailure)
     else:
       # announce game to everyone
@@ -178,9 +260,6 @@ class Roomd(MetaProtocol):
     return True
   
   def handleStartGamePacket(self, packet):
-    if self.state != self.LOGGED_IN:
-      self.sendMessage(MessagePacket.NOT_LOGGED_IN)
-      return False
     if self.game_info is None:
       self.sendMessage(MessagePacket.SYNTAX_ERROR)
       return False
@@ -196,9 +275,6 @@ class Roomd(MetaProtocol):
     return True
   
   def handleRemoveGamePacket(self, packet):
-    if self.state != self.LOGGED_IN:
-      self.sendMessage(MessagePacket.NOT_LOGGED_IN)
-      return False
     if self.game_info is not None:
       self.logEvent('remove game')
       self.sendGameList(self.game_info.game_id, 0, self.VERB_DELETE)
@@ -210,9 +286,6 @@ class Roomd(MetaProtocol):
     return True
   
   def handleIncomingChatPacket(self, packet):
-    if self.state != self.LOGGED_IN:
-      self.sendMessage(MessagePacket.NOT_LOGGED_IN)
-      return False
     if packet.sender_id != self.user_id:
       self.sendMessage(MessagePacket.SYNTAX_ERROR)
       return False
@@ -225,9 +298,6 @@ class Roomd(MetaProtocol):
     return True
   
   def handleIncomingPrivateMessagePacket(self, packet):
-    if self.state != self.LOGGED_IN:
-      self.sendMessage(MessagePacket.NOT_LOGGED_IN)
-      return False
     if packet.sender_id != self.user_id or packet.header_target_id != packet.target_id:
       self.sendMessage(MessagePacket.SYNTAX_ERROR)
       return False
@@ -249,15 +319,44 @@ class Roomd(MetaProtocol):
   
   def handleLogoutPacket(self, packet):
     self.deaf = True
+    self.updateMembership()
     # rest of cleanup will occur in connectionLost
     return False
 
+  def loseConnection(self):
+    # dropped on purpose (logout, kick, protocol error): no resuming
+    self.resumable = False
+    MetaProtocol.loseConnection(self)
+  
+  def keepaliveTimeout(self):
+    MetaProtocol.loseConnection(self)
+  
   def connectionLost(self, reason):
     MetaProtocol.connectionLost(self, reason)
-    if self.user_info is not None:
+    if self.user_info is not None and self.user_info.roomd_connection is self:
       self.user_info.roomd_connection = None
+      if self.resumable and (self.state == self.LOGGED_IN or self.resuming) and self.factory.RESUME_GRACE > 0:
+        self.holdSession()
+        return
+    self.depart()
+  
+  def holdSession(self):
+    # The user stays in the roster and their game stays listed, but
+    # nothing is sent to them; the room only hears of it if they are
+    # not back within RESUME_GRACE seconds (see depart).
+    listening = self.globals['listening']
+    if listening.get(self.user_id) is self.user_info:
+      del listening[self.user_id]
+    log.msg("holding session of user %d for %g seconds" % (self.user_id, self.factory.RESUME_GRACE))
+    self.factory.hold(self)
+  
+  def depart(self):
+    if self.factory.unhold(self):
+      self.factory.resume_stats['departed'] += 1
+    if self.user_info is not None and self.user_info.roomd_connection is None:
+      self.updateMembership()
     did_change = False
-    if self.state == self.LOGGED_IN:
+    if self.state == self.LOGGED_IN or self.resuming:
       if self.game_info is not None:
         self.logEvent('remove game')
         self.sendGameList(self.game_info.game_id, 0, self.VERB_DELETE)
@@ -267,6 +366,7 @@ class Roomd(MetaProtocol):
       did_change = True
     self.userd.cleanUser(self.user_id)
     self.userd.debugGlobals()
+    self.factory.logStats()
     if did_change:
       self.checkRainbow()
 
@@ -286,8 +386,84 @@ class Roomd(MetaProtocol):
       for info in self.visibleUsersInRoom():
         if not info.user_id == (0 - send):
           send_list.append(info)
+    self.sendPlayerInfoList(send_list, recip, verb)
+  
+  def sendPlayerInfoList(self, send_list, recip, verb):
+    if recip <= 0 and verb != self.VERB_DELETE:
+      # room-wide changes are skipped for players whose data is the
+      # same as when it was last announced to the room
+      if verb == self.VERB_CHANGE:
+        send_list = [ info for info in send_list if info.roomPlayerDataChunk(verb) != info.announced_chunk ]
+      for info in send_list:
+        info.announced_chunk = info.roomPlayerDataChunk(self.VERB_CHANGE)
     if len(send_list) > 0:
-      self.sendPacketToRoom(PlayerListPacket(send_list, verb), recip)
+      self.queuePlayerList(send_list, recip, verb)
+  
+  def queuePlayerList(self, send_list, recip, verb):
+    # Player list updates are merged per recipient and sent by the
+    # factory a short time later, so a burst of joins and leaves costs
+    # each member one packet instead of one per event.
+    if recip > 0:
+      if not self.isUserIdListening(recip):
+        return
+      recipients = [ self.globals['users'][recip] ]
+    else:
+      recipients = self.listeningUsersInRoom()
+    for info in recipients:
+      if info.user_id != (0 - recip):
+        info.roomd_connection.mergePlayerList(send_list, verb)
+  
+  # (pending verb, new verb) -> merged verb; None drops the update
+  _merged_verbs = {
+    (VERB_ADD, VERB_ADD) : VERB_ADD,
+    (VERB_ADD, VERB_CHANGE) : VERB_ADD,
+    (VERB_ADD, VERB_DELETE) : None,
+    (VERB_CHANGE, VERB_ADD) : VERB_ADD,
+    (VERB_CHANGE, VERB_CHANGE) : VERB_CHANGE,
+    (VERB_CHANGE, VERB_DELETE) : VERB_DELETE,
+    (VERB_DELETE, VERB_ADD) : VERB_CHANGE,
+    (VERB_DELETE, VERB_CHANGE) : VERB_DELETE,
+    (VERB_DELETE, VERB_DELETE) : VERB_DELETE }
+  
+  def mergePlayerList(self, send_list, verb):
+    pending = self._pending_players
+    if not pending:
+      self.factory.playerListPending(self)
+    for info in send_list:
+      uid = info.user_id
+      entry = pending.get(uid)
+      if entry is None:
+        pending[uid] = (verb, info)
+      else:
+        merged = self._merged_verbs[(entry[0], verb)]
+        if merged is None:
+          del pending[uid]
+        else:
+          pending[uid] = (merged, info)
+  
+  def flushPlayerList(self, frames=None):
+    pending = self._pending_players
+    if not pending:
+      return False
+    self._pending_players = {}
+    if self.globals['listening'].get(self.user_id) is not self.user_info or self.user_info.roomd_connection is not self:
+      return False
+    # recipients with the same pending updates share one framed packet
+    key = tuple((uid, verb) for uid, (verb, info) in pending.items())
+    data = frames.get(key) if frames is not None else None
+    if data is None:
+      data = self.framePacket(PlayerListPacket(pending.values()))
+      if frames is not None:
+        frames[key] = data
+    MetaProtocol.sendFrame(self, data)
+    return True
+  
+  def sendFrame(self, data):
+    # anything else sent to this user goes out after the player list
+    # updates queued before it
+    if self._pending_players:
+      self.flushPlayerList()
+    MetaProtocol.sendFrame(self, data)
   
   def sendGameList(self, send, recip, verb):
     send_list = self.buildSendList('games', send)
@@ -312,154 +488,119 @@ class Roomd(MetaProtocol):
       if self.isUserIdListening(recip):
         self.globals['users'][recip].roomd_connection.sendPacket(packet)
     else:
+      # frame once and hand the same bytes to every listener
+      data = self.framePacket(packet)
+      count = 0
       for info in self.listeningUsersInRoom():
         if not info.user_id == (0 - recip):
-          info.roomd_connection.sendPacket(packet)
+          info.roomd_connection.sendFrame(data)
+          count += 1
+      log.msg("broadcast %s (%d bytes) to %d users" % (packet.__class__.__name__.rsplit('.', 1).pop(), len(data) - self._fmt.size, count))
             
-  def remoteCreateGameResult(self, rs, server_id, verb):
-    if self.state != self.LOGGED_IN:
-      log.msg("Remote hub create game in wrong context")
-      self.transport.loseConnection()
+  def remoteCreateGameResolved(self, ipaddress, host, port, server_id, verb):
+    if self.game_info is None or self.game_info.remote_hub_id != server_id or self.user_info.roomd_connection is not self:
       return
-  
-    if len(rs) != 1:
-      log.msg("Found %d remote servers in database for id %d. Was expecting 1." % (len(rs), server_id))
-      self.transport.loseConnection()
-      return
-  
-    try:
-      ipaddress = socket.gethostbyname(rs[0][0])
-    except:
-      log.msg("Can't resolve remote hub address anymore from host %s" % rs[0][0])
-      self.transport.loseConnection()
+    
+    if ipaddress is None:
+      log.msg("Can't resolve remote hub address anymore from host %s" % host)
+      self.loseConnection()
       return
   
     self.game_info.host = ipaddress
-    self.game_info.port = rs[0][1]
-    self.game_info.remote_hub_id = server_id
+    self.game_info.port = port
     self.sendGameList(self.game_info.game_id, 0, verb)
     
   def remoteCreateGameFailure(self, failure):
     log.msg("Remote hub lookup failure: %s" % str(failure))
-    self.transport.loseConnection()
+    self.loseConnection()
 
   def logChat(self, message):
     if self.log_chat:
-      deferred = self.dbpool.runOperation("""
-        INSERT INTO chatlog
-        (event_date, event_type,
-         user_id, username, chatname,
-         color_r, color_g, color_b,
-         message)
-        VALUES (NOW(), %s,
-                %s, %s, %s,
-                %s, %s, %s,
-                %s)""",
-        ('chat',
-        self.user_info.user_id, self.user_info.username, self.user_info.chatname,
-        self.user_info.player_info.player_color[0],
-        self.user_info.player_info.player_color[1],
-        self.user_info.player_info.player_color[2],
-        message))
-      deferred.addErrback(self.reportDbError)
+      self.logwriter.write('chatlog',
+        event_type='chat',
+        user_id=self.user_info.user_id, username=self.user_info.username, chatname=self.user_info.chatname,
+        color_r=self.user_info.player_info.player_color[0],
+        color_g=self.user_info.player_info.player_color[1],
+        color_b=self.user_info.player_info.player_color[2],
+        message=message)
   
   def logBroadcast(self, message):
     if self.log_chat:
-      deferred = self.dbpool.runOperation("""
-        INSERT INTO chatlog
-        (event_date, event_type,
-         user_id, username, chatname,
-         message)
-        VALUES (NOW(), %s,
-                %s, %s, %s,
-                %s)""",
-        ('broadcast',
-        self.user_info.user_id, self.user_info.username, self.user_info.chatname,
-        message))
-      deferred.addErrback(self.reportDbError)
+      self.logwriter.write('chatlog',
+        event_type='broadcast',
+        user_id=self.user_info.user_id, username=self.user_info.username, chatname=self.user_info.chatname,
+        message=message)
   
   def logPM(self, target, message):
     if self.log_chat:
-      deferred = self.dbpool.runOperation("""
-        INSERT INTO chatlog
-        (event_date, event_type,
-         user_id, username, chatname,
-         target_user_id, target_username, target_chatname,
-         color_r, color_g, color_b,
-         message)
-        VALUES (NOW(), %s,
-                %s, %s, %s,
-                %s, %s, %s,
-                %s, %s, %s,
-                %s)""",
-        ('pm',
-        self.user_info.user_id, self.user_info.username, self.user_info.chatname,
-        target.user_id, target.username, target.chatname,
-        self.user_info.player_info.player_color[0],
-        self.user_info.player_info.player_color[1],
-        self.user_info.player_info.player_color[2],
-        message))
-      deferred.addErrback(self.reportDbError)
+      self.logwriter.write('chatlog',
+        event_type='pm',
+        user_id=self.user_info.user_id, username=self.user_info.username, chatname=self.user_info.chatname,
+        target_user_id=target.user_id, target_username=target.username, target_chatname=target.chatname,
+        color_r=self.user_info.player_info.player_color[0],
+        color_g=self.user_info.player_info.player_color[1],
+        color_b=self.user_info.player_info.player_color[2],
+        message=message)
   
   def logEvent(self, type, data=None):
     if self.log_events:
-      deferred = self.dbpool.runOperation("""
-        INSERT INTO eventlog
-        (event_date, event_type, username, user_id, extradata)
-        VALUES (NOW(), %s, %s, %s, %s)""",
-        (type, self.user_info.username, self.user_id, data))
-      deferred.addErrback(self.reportDbError)
+      self.logwriter.write('eventlog',
+        event_type=type, username=self.user_info.username, user_id=self.user_id, extradata=data)
   
   def logLogin(self):
     if self.log_logindetail and self.user_info.visible:
-      deferred = self.dbpool.runOperation("""
-        INSERT INTO logindetail
-        (event_date, username, user_id, chatname,
-         color_r, color_g, color_b,
-         team_color_r, team_color_g, team_color_b,
-         build_date, platform_type)
-        VALUES(NOW(), %s, %s, %s,
-               %s, %s, %s,
-               %s, %s, %s,
-               STR_TO_DATE(%s, "%%b %%e %%Y %%T"), %s)""",
-        (self.user_info.username, self.user_id, self.user_info.chatname,
-         self.user_info.player_info.player_color[0],
-         self.user_info.player_info.player_color[1],
-         self.user_info.player_info.player_color[2],
-         self.user_info.player_info.team_color[0],
-         self.user_info.player_info.team_color[1],
-         self.user_info.player_info.team_color[2],
-         self.user_info.player_info.build_date + b' ' + self.user_info.player_info.build_time,
-         self.user_info.player_info.platform_type))
-      deferred.addErrback(self.reportDbError)
-  
-  def reportDbError(self, failure):
-    log.msg("Database failure: %s" % str(failure))
+      self.logwriter.write('logindetail',
+        username=self.user_info.username, user_id=self.user_id, chatname=self.user_info.chatname,
+        color_r=self.user_info.player_info.player_color[0],
+        color_g=self.user_info.player_info.player_color[1],
+        color_b=self.user_info.player_info.player_color[2],
+        team_color_r=self.user_info.player_info.team_color[0],
+        team_color_g=self.user_info.player_info.team_color[1],
+        team_color_b=self.user_info.player_info.team_color[2],
+        build_date=self.user_info.player_info.build_date + b' ' + self.user_info.player_info.build_time,
+        platform_type=self.user_info.player_info.platform_type)
+  
+  def updateMembership(self):
+    # The room keeps an ordered roster of its visible members and an
+    # index of its listening members; call this after any change to
+    # state, deaf, visible, or the user's sort order (afk, in_game).
+    # The same changes pick the connection's keepalive profile.
+    uid = self.user_id
+    in_room = self.state == self.LOGGED_IN and self.user_info.roomd_connection is self
+    if in_room and self.user_info.visible:
+      self.globals['roster'].update(self.user_info)
+    else:
+      self.globals['roster'].discard(self.user_info)
+    listening = self.globals['listening']
+    if in_room and not self.deaf:
+      listening[uid] = self.user_info
+    elif listening.get(uid) is self.user_info:
+      del listening[uid]
+    if not in_room:
+      self.setKeepaliveProfile('handshake')
+    elif self.deaf:
+      self.setKeepaliveProfile('ingame')
+    elif self.user_info.afk is not None:
+      self.setKeepaliveProfile('afk')
+    else:
+      self.setKeepaliveProfile('active')
   
   def isUserIdVisible(self, user_id):
-    if user_id in self.globals['users']:
-      info = self.globals['users'][user_id]
-      conn = info.roomd_connection
-      if conn and conn.state == self.LOGGED_IN and info.visible:
-        return True
-    return False
+    return user_id in self.globals['roster']
 
   def isUserIdListening(self, user_id):
-    if user_id in self.globals['users']:
-      conn = self.globals['users'][user_id].roomd_connection
-      if conn and conn.state == self.LOGGED_IN and not conn.deaf:
-        return True
-    return False
+    return user_id in self.globals['listening']
 
   def visibleUsersInRoom(self):
-    return list(filter(lambda info: info.roomd_connection and info.roomd_connection.state == self.LOGGED_IN and info.visible, list(self.globals['users'].values())))
+    return self.globals['roster'].members.values()
 
   def listeningUsersInRoom(self):
-    return list(filter(lambda info: info.roomd_connection and info.roomd_connection.state == self.LOGGED_IN and not info.roomd_connection.deaf, list(self.globals['users'].values())))
+    return self.globals['listening'].values()
 
   def userActive(self):
     if self.user_info.afk is not None:
       self.user_info.afk = None
+      self.updateMembership()
       self.sendPlayerList(self.user_id, 0, self.VERB_CHANGE)
       self.checkRainbow()
       
@@ -473,6 +614,7 @@ class Roomd(MetaProtocol):
       if len(words) > 1:
         away_msg = ' '.join(words[1:])
       self.user_info.afk = away_msg.encode('mac_roman')
+      self.updateMembership()
       self.sendPlayerList(self.user_id, 0, self.VERB_CHANGE)
       self.checkRainbow()
     elif words[0] == ".back":
@@ -504,12 +646,15 @@ class Roomd(MetaProtocol):
     elif words[0] == ".kick" and self.user_info.moderator:
       if target is None:
         self.sendRoomMessage("No user selected")
-      elif target.roomd_connection:
+      elif target.roomd_connection or target.held is not None:
         extra = ''
         if target.username:
           extra = ' [' + target.username.decode('mac_roman') + ']'
         self.logEvent('kick', target.chatname.decode('mac_roman') + extra)
-        target.roomd_connection.transport.loseConnection()
+        if target.roomd_connection:
+          target.roomd_connection.loseConnection()
+        else:
+          target.held.depart()
         self.broadcastRoomMessage('Moderator ' + self.user_info.chatname.decode('mac_roman') + ' kicked ' + target.chatname.decode('mac_roman'))
     elif words[0] == ".rainbow" and self.user_info.moderator:
       if self.globals['rainbow'] is None:
@@ -565,54 +710,96 @@ class Roomd(MetaProtocol):
         self.sendRoomMessage("Test failed. You cannot gather games.")
 
   def checkRainbow(self):
-    changed = False
-    if self.globals['rainbow'] == 'rainbow':
-      # check if any moderators are still in the room; count visible users
-      cancel = True
-      num_users = 0
-      for user_info in self.visibleUsersInRoom():
-        if user_info.moderator:
-          cancel = False
-        num_users += 1
-      if cancel:
-        self.globals['rainbow'] = None
-        self.resetColors()
-        return
+    if self.globals['rainbow'] != 'rainbow':
+      return
+    # cancel if no moderators are left in the room
+    roster = self.globals['roster']
+    if not roster.moderators:
+      self.globals['rainbow'] = None
+      self.resetColors()
+      return
     
-      index = 0
-      for user_info in sorted(self.visibleUsersInRoom()):
-        color1 = UserInfo.rainbow_for_pos(index, num_users)
-        color2 = UserInfo.rainbow_for_pos(index + 1, num_users)
-        if user_info.player_info.player_color != color1:
-          user_info.player_info.player_color = color1
-          changed = True
-        if user_info.player_info.team_color != color2:
-          user_info.player_info.team_color = color2
-          changed = True
-        index += 1
-      
-    if changed:
-      self.sendPlayerList(0, 0, self.VERB_CHANGE)
+    palette = UserInfo.rainbow_palette(len(roster))
+    moved = []
+    index = 0
+    for user_info in roster.ordered():
+      color1 = palette[index % len(palette)]
+      color2 = palette[(index + 1) % len(palette)]
+      if user_info.set_colors(color1, color2):
+        moved.append(user_info)
+      index += 1
+    
+    if moved:
+      self.sendPlayerInfoList(moved, 0, self.VERB_CHANGE)
       
   def resetColors(self):
-    changed = False
+    moved = []
     for user_info in self.visibleUsersInRoom():
-      if user_info.player_info.player_color != user_info.original_player_color:
-        user_info.player_info.player_color = user_info.original_player_color
-        changed = True
-      if user_info.player_info.team_color != user_info.original_team_color:
-        user_info.player_info.team_color = user_info.original_team_color
-        changed = True
+      if user_info.set_colors(user_info.original_player_color, user_info.original_team_color):
+        moved.append(user_info)
       
-    if changed:
-      self.sendPlayerList(0, 0, self.VERB_CHANGE)
+    if moved:
+      self.sendPlayerInfoList(moved, 0, self.VERB_CHANGE)
 
 class RoomdFactory(Factory):
 
-  def __init__(self, userd_factory, options=None):
+  PLAYER_LIST_DELAY = 0.1
+  RESUME_GRACE = 15
+
+  def __init__(self, userd_factory, options=None, signer=None):
 #     Factory.__init__(self)
     self.userd_factory = userd_factory
     self.options = options
+    self.signer = signer
+    self.held = {}          # resume credential -> dropped Roomd connection
+    self.resume_stats = { 'held' : 0, 'resumed' : 0, 'departed' : 0 }
+    self._player_list_pending = []
+    self._player_list_call = None
+  
+  def playerListPending(self, connection):
+    self._player_list_pending.append(connection)
+    if self._player_list_call is None:
+      self._player_list_call = reactor.callLater(self.PLAYER_LIST_DELAY, self.flushPlayerLists)
+  
+  def flushPlayerLists(self):
+    self._player_list_call = None
+    pending = self._player_list_pending
+    self._player_list_pending = []
+    frames = {}
+    sent = 0
+    for connection in pending:
+      if connection.flushPlayerList(frames):
+        sent += 1
+    if sent > 0:
+      log.msg("sent player list updates to %d users (%d distinct)" % (sent, len(frames)))
+  
+  def hold(self, connection):
+    self.held[connection.resume_credential] = connection
+    connection.user_info.held = connection
+    connection.resume_call = reactor.callLater(self.RESUME_GRACE, connection.depart)
+    self.resume_stats['held'] += 1
+  
+  def unhold(self, connection):
+    if self.held.get(connection.resume_credential) is not connection:
+      return False
+    del self.held[connection.resume_credential]
+    connection.user_info.held = None
+    if connection.resume_call.active():
+      connection.resume_call.cancel()
+    connection.resume_call = None
+    return True
+  
+  def resume(self, credential, username):
+    connection = self.held.get(credential)
+    if connection is None or (connection.user_info.username or b'guest') != (username or b'guest'):
+      return None
+    self.unhold(connection)
+    self.resume_stats['resumed'] += 1
+    return connection
+  
+  def logStats(self):
+    s = self.resume_stats
+    log.msg("Room sessions: %d held now; %d held, %d resumed, %d not resumed in time" % (len(self.held), s['held'], s['resumed'], s['departed']))
   
   def buildProtocol(self, addr):
     return Roomd(self)
@@ -0,0 +1,250 @@
+# Copyright (C) 2014 and beyond by Jeremiah Morris
+# and contributing developers.
+#
+# This file is part of Metaserver.
+#
+# Metaserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Metaserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import reactor, defer, task
+from twisted.python import log
+from CircuitBreaker import CircuitBreaker
+from collections import deque
+import datetime
+
+# Everything the server keeps in a database goes through one of these
+# classes. All of them offer the same calls, each returning a Deferred:
+#
+#   users()                 all (username, password, hide_in_room,
+#                           moderator, sort_order) rows
+#   user(username)          a list of zero or one (password,
+#                           hide_in_room, moderator, sort_order) rows
+#   loginToken(username)    a list of zero or one (token, fresh,
+#                           hide_in_room, moderator, sort_order) rows;
+#                           fresh is true if the token was set within
+#                           TOKEN_MAX_AGE seconds
+#   clearLoginToken(username)
+#   remoteHubs()            all (id, network_version, host, port) rows
+#   insertRows(table, columns, rows)
+#
+# Usernames are passed as bytes. breaker is the circuit breaker in front
+# of the database, or None.
+
+TOKEN_MAX_AGE = 60
+
+def parseBuildDate(value):
+  # Aleph One sends __DATE__ and __TIME__, e.g. "Jan  5 2024 12:34:56";
+  # spooled rows may already hold a datetime or its isoformat()
+  if value is None or isinstance(value, datetime.datetime):
+    return value
+  if isinstance(value, bytes):
+    value = value.decode('ascii', 'replace')
+  for parse in (lambda v: datetime.datetime.strptime(v, '%b %d %Y %H:%M:%S'), datetime.datetime.fromisoformat):
+    try:
+      return parse(value.strip())
+    except ValueError:
+      pass
+  return None
+
+def prepareRows(columns, rows):
+  if 'build_date' not in columns:
+    return rows
+  i = list(columns).index('build_date')
+  return [ tuple(row[:i]) + (parseBuildDate(row[i]),) + tuple(row[i + 1:]) for row in rows ]
+
+def insertStatement(table, columns, rows, placeholder='%s'):
+  row_sql = "(%s)" % ', '.join([ placeholder ] * len(columns))
+  sql = "INSERT INTO %s (%s) VALUES %s" % (table, ', '.join(columns), ', '.join([ row_sql ] * len(rows)))
+  return sql, [ value for row in rows for value in row ]
+
+class MySQLStorage:
+
+  # The tables described in database.md, reached through dbpool: a
+  # connection pool or a circuit breaker wrapping one.
+
+  def __init__(self, dbpool):
+    self.dbpool = dbpool
+    self.breaker = dbpool if isinstance(dbpool, CircuitBreaker) else None
+
+  def users(self):
+    return self.dbpool.runQuery("SELECT username, password, hide_in_room, moderator, sort_order FROM user")
+
+  def user(self, username):
+    return self.dbpool.runQuery("SELECT password, hide_in_room, moderator, sort_order FROM user WHERE BINARY username = %s", (username,))
+
+  def loginToken(self, username):
+    return self.dbpool.runQuery("SELECT meta_login_token, meta_login_token_date + INTERVAL %s SECOND > NOW(), hide_in_room, moderator, sort_order FROM user WHERE BINARY username = %s", (TOKEN_MAX_AGE, username))
+
+  def clearLoginToken(self, username):
+    return self.dbpool.runOperation("UPDATE user SET meta_login_token = NULL, meta_login_token_date = NULL WHERE BINARY username = %s", (username,))
+
+  def remoteHubs(self):
+    return self.dbpool.runQuery("SELECT id, network_version, host, port FROM remotehub")
+
+  def insertRows(self, table, columns, rows):
+    sql, args = insertStatement(table, columns, prepareRows(columns, rows))
+    return self.dbpool.runOperation(sql, args)
+
+  def logStats(self):
+    pool = self.dbpool
+    if self.breaker is not None:
+      self.breaker.logStats()
+      pool = self.breaker.pool
+    if hasattr(pool, 'logStats'):
+      pool.logStats()
+
+class SQLiteStorage(MySQLStorage):
+
+  # The same tables in an SQLite file, for servers too small to need a
+  # database server. dbpool should be an adbapi pool for sqlite3 with a
+  # single thread. Missing tables are created; meta_login_token must
+  # be stored as a blob and meta_login_token_date as local time in
+  # "YYYY-MM-DD HH:MM:SS" form.
+
+  schema = [
+    """CREATE TABLE IF NOT EXISTS user (
+      sort_order INTEGER,
+      username TEXT UNIQUE,
+      password TEXT,
+      moderator BOOLEAN,
+      hide_in_room BOOLEAN,
+      meta_login_token BLOB,
+      meta_login_token_date TEXT )""",
+    """CREATE TABLE IF NOT EXISTS remotehub (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      host TEXT NOT NULL,
+      port INTEGER NOT NULL,
+      network_version TEXT NOT NULL,
+      UNIQUE (host, port) )""",
+    """CREATE TABLE IF NOT EXISTS chatlog (
+      event_date TEXT, event_type TEXT, user_id INTEGER, username BLOB,
+      chatname BLOB, color_r INTEGER, color_g INTEGER, color_b INTEGER,
+      target_user_id INTEGER, target_username BLOB, target_chatname BLOB,
+      message BLOB )""",
+    """CREATE TABLE IF NOT EXISTS eventlog (
+      event_date TEXT, event_type TEXT, username BLOB, user_id INTEGER,
+      extradata BLOB )""",
+    """CREATE TABLE IF NOT EXISTS logindetail (
+      event_date TEXT, username BLOB, user_id INTEGER, chatname BLOB,
+      color_r INTEGER, color_g INTEGER, color_b INTEGER,
+      team_color_r INTEGER, team_color_g INTEGER, team_color_b INTEGER,
+      build_date TEXT, platform_type INTEGER )""" ]
+
+  def __init__(self, dbpool):
+    MySQLStorage.__init__(self, dbpool)
+    # the pool's one thread runs this before any other query
+    self.dbpool.runInteraction(self.createTables).addErrback(log.err, "SQLite schema setup failed")
+
+  def createTables(self, txn):
+    for sql in self.schema:
+      txn.execute(sql)
+
+  def name(self, username):
+    # usernames are text columns; bytes would bind as a blob and never match
+    return username.decode('utf8', 'replace') if isinstance(username, bytes) else username
+
+  def user(self, username):
+    return self.dbpool.runQuery("SELECT password, hide_in_room, moderator, sort_order FROM user WHERE username = ?", (self.name(username),))
+
+  def loginToken(self, username):
+    return self.dbpool.runQuery("SELECT meta_login_token, meta_login_token_date > datetime('now', 'localtime', ?), hide_in_room, moderator, sort_order FROM user WHERE username = ?", ('-%d seconds' % TOKEN_MAX_AGE, self.name(username)))
+
+  def clearLoginToken(self, username):
+    return self.dbpool.runOperation("UPDATE user SET meta_login_token = NULL, meta_login_token_date = NULL WHERE username = ?", (self.name(username),))
+
+  def insertRows(self, table, columns, rows):
+    rows = [ tuple(value.isoformat(' ') if isinstance(value, datetime.datetime) else value for value in row) for row in prepareRows(columns, rows) ]
+    sql, args = insertStatement(table, columns, rows, '?')
+    return self.dbpool.runOperation(sql, args)
+
+class MemoryStorage:
+
+  # Keeps everything in dictionaries, for load tests and development.
+  # Each call answers after latency seconds: a number, or a function
+  # called with the name of the call that returns one, so tests can
+  # model a database of known speed or leave it out entirely. Logged
+  # rows are kept per table, the last max_rows of each.
+
+  def __init__(self, latency=0, max_rows=10000):
+    self.latency = latency
+    self.breaker = None
+    self.accounts = {}      # username -> [password, hide_in_room, moderator, sort_order, token, token time]
+    self.hubs = {}          # id -> (network_version, host, port)
+    self.rows = {}          # table -> deque of dicts
+    self.max_rows = max_rows
+    self.stats = {
+      'calls' : 0,
+      'inserted' : 0 }
+
+  def addUser(self, username, password, hide_in_room=False, moderator=False, sort_order=None):
+    if sort_order is None:
+      sort_order = len(self.accounts) + 1
+    self.accounts[username] = [password, hide_in_room, moderator, sort_order, None, None]
+
+  def setLoginToken(self, username, token):
+    account = self.accounts[username]
+    account[4] = token
+    account[5] = reactor.seconds()
+
+  def addRemoteHub(self, host, port, network_version):
+    hub_id = max(self.hubs, default=0) + 1
+    self.hubs[hub_id] = (network_version, host, port)
+    return hub_id
+
+  def answer(self, call, f, *args):
+    self.stats['calls'] += 1
+    delay = self.latency(call) if callable(self.latency) else self.latency
+    if delay > 0:
+      return task.deferLater(reactor, delay, f, *args)
+    return defer.maybeDeferred(f, *args)
+
+  def users(self):
+    return self.answer('users', lambda: [ (username, a[0], a[1], a[2], a[3]) for username, a in self.accounts.items() ])
+
+  def user(self, username):
+    def find():
+      a = self.accounts.get(username)
+      return [ (a[0], a[1], a[2], a[3]) ] if a is not None else []
+    return self.answer('user', find)
+
+  def loginToken(self, username):
+    def find():
+      a = self.accounts.get(username)
+      if a is None:
+        return []
+      fresh = a[5] is not None and a[5] + TOKEN_MAX_AGE > reactor.seconds()
+      return [ (a[4], fresh, a[1], a[2], a[3]) ]
+    return self.answer('loginToken', find)
+
+  def clearLoginToken(self, username):
+    def clear():
+      a = self.accounts.get(username)
+      if a is not None:
+        a[4] = a[5] = None
+    return self.answer('clearLoginToken', clear)
+
+  def remoteHubs(self):
+    return self.answer('remoteHubs', lambda: [ (hub_id,) + hub for hub_id, hub in self.hubs.items() ])
+
+  def insertRows(self, table, columns, rows):
+    def insert():
+      kept = self.rows.get(table)
+      if kept is None:
+        kept = self.rows[table] = deque(maxlen=self.max_rows)
+      for row in prepareRows(columns, rows):
+        kept.append(dict(zip(columns, row)))
+      self.stats['inserted'] += len(rows)
+    return self.answer('insertRows', insert)
+
+  def logStats(self):
+    log.msg("Memory storage: %d users, %d remote hubs, %d calls, %d rows inserted" % (len(self.accounts), len(self.hubs), self.stats['calls'], self.stats['inserted']))
@@ -0,0 +1,135 @@
+# Copyright (C) 2014 and beyond by Jeremiah Morris
+# and contributing developers.
+#
+# This file is part of Metaserver.
+#
+# Metaserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Metaserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import reactor, task
+from twisted.python import log
+import heapq
+import secrets
+
+# record fields
+USER_ID = 0
+ACTIVE = 1
+DEADLINE = 2
+
+class TokenStore:
+
+  # The login tokens userd hands out for the room connection. A token
+  # is issued inactive when a user id is assigned, activated once the
+  # login completes, and redeemed (once) by roomd, or expired.
+  #
+  # Each token has a record [user_id, active, deadline]. expireLater
+  # sets a deadline and pushes it on a heap, which one timer sweeps
+  # every sweep_interval seconds while deadlines are pending; expired
+  # tokens are passed to on_expire(token, user_id). Redeeming or
+  # expiring a token early only drops its record, and the sweep skips
+  # heap entries that no longer match a record. Deadlines are all set
+  # the same delay ahead, so each push lands at the end of the heap
+  # and costs one comparison.
+
+  def __init__(self, on_expire=None, sweep_interval=1.0):
+    self.on_expire = on_expire
+    self.sweep_interval = sweep_interval
+    self.records = {}
+    self.deadlines = []       # heap of (deadline, token)
+    self.sweeper = None
+    self.stats = {
+      'issued' : 0,
+      'activated' : 0,
+      'redeemed' : 0,
+      'refused' : 0,
+      'expired' : 0,
+      'timed_out' : 0 }
+
+  def __len__(self):
+    return len(self.records)
+
+  def __contains__(self, token):
+    return token in self.records
+
+  def newToken(self):
+    # 128 random bits, as 32 hex digits like the uuid4 tokens before
+    return secrets.token_hex(16).encode('ascii')
+
+  def issue(self, user_id):
+    token = self.newToken()
+    self.records[token] = [user_id, False, None]
+    self.stats['issued'] += 1
+    return token
+
+  def activate(self, token):
+    record = self.records.get(token)
+    if record is None:
+      return False
+    record[ACTIVE] = True
+    self.stats['activated'] += 1
+    return True
+
+  def redeem(self, token):
+    # (user_id, True) for an active token, (user_id, False) for one not
+    # yet active, (None, False) for an unknown one; a known token is
+    # used up either way
+    record = self.records.pop(token, None)
+    if record is None or not record[ACTIVE]:
+      self.stats['refused'] += 1
+      return record[USER_ID] if record is not None else None, False
+    self.stats['redeemed'] += 1
+    return record[USER_ID], True
+
+  def expire(self, token):
+    record = self.records.pop(token, None)
+    if record is None:
+      return None
+    self.stats['expired'] += 1
+    return record[USER_ID]
+
+  def expireLater(self, token, delay):
+    record = self.records.get(token)
+    if record is None:
+      return
+    record[DEADLINE] = reactor.seconds() + delay
+    heapq.heappush(self.deadlines, (record[DEADLINE], token))
+    if self.sweeper is None:
+      self.sweeper = task.LoopingCall(self.sweep)
+      self.sweeper.clock = reactor
+      self.sweeper.start(self.sweep_interval, now=False)
+
+  def sweep(self):
+    now = reactor.seconds()
+    deadlines = self.deadlines
+    while deadlines and deadlines[0][0] <= now:
+      deadline, token = heapq.heappop(deadlines)
+      record = self.records.get(token)
+      if record is None or record[DEADLINE] != deadline:
+        continue
+      del self.records[token]
+      self.stats['timed_out'] += 1
+      if self.on_expire is not None:
+        self.on_expire(token, record[USER_ID])
+    if not deadlines:
+      self.sweeper.stop()
+      self.sweeper = None
+
+  def tokens(self):
+    # (token, user_id, active) for every live token
+    return [ (token, record[USER_ID], record[ACTIVE]) for token, record in self.records.items() ]
+
+  def logStats(self):
+    s = self.stats
+    active = sum(1 for record in self.records.values() if record[ACTIVE])
+    log.msg("Tokens: %d live (%d active), %d expiry heap entries; %d issued, %d activated, %d redeemed, %d refused, %d expired, %d timed out"
+            % (len(self.records), active, len(self.deadlines), s['issued'], s['activated'], s['redeemed'], s['refused'], s['expired'], s['timed_out']))
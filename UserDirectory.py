@@ -0,0 +1,164 @@
+# Copyright (C) 2014 and beyond by Jeremiah Morris
+# and contributing developers.
+#
+# This file is part of Metaserver.
+#
+# Metaserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Metaserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.application import service
+from twisted.internet import reactor, defer, task
+from twisted.python import log
+from CircuitBreaker import BreakerOpen
+from collections import OrderedDict
+
+class UserDirectory(service.Service):
+
+  # Keeps the password, hide_in_room, moderator and sort_order columns
+  # of the user table in memory, keyed by username. The table is loaded
+  # at startup and reloaded every refresh_interval seconds; only rows
+  # that changed are replaced. Names missing from the directory are
+  # looked up directly, and names the database does not know either
+  # are remembered for negative_ttl seconds (at most negative_max of
+  # them). Once the table is loaded, no more than max_miss_queries
+  # direct lookups run at a time; past that, unknown names are refused
+  # without a query, so floods of made-up usernames cannot queue up
+  # work in the database pool.
+  #
+  # While the database circuit breaker is open, only users whose
+  # password was verified in the last degraded_window seconds are
+  # looked up; everyone else fails with BreakerOpen. A degraded_window
+  # of 0 refuses all registered logins while the database is down.
+
+  def __init__(self, storage, refresh_interval=300, negative_ttl=60, negative_max=10000, max_miss_queries=4, degraded_window=86400):
+    self.storage = storage
+    self.breaker = storage.breaker
+    self.degraded_window = degraded_window
+    self.last_verified = {}       # username -> time of last good password
+    self.refresh_interval = refresh_interval
+    self.negative_ttl = negative_ttl
+    self.negative_max = negative_max
+    self.max_miss_queries = max_miss_queries
+    self.users = {}               # username -> (password, hide_in_room, moderator, sort_order)
+    self.missing = OrderedDict()  # username -> expiry, oldest first
+    self.loaded = False
+    self.loading = False
+    self.miss_queries = 0
+    self.refresher = None
+    self.stats = {
+      'hits' : 0,
+      'negative_hits' : 0,
+      'queries' : 0,
+      'refused' : 0,
+      'degraded' : 0,
+      'degraded_refused' : 0,
+      'loads' : 0,
+      'changed' : 0 }
+
+  def startService(self):
+    service.Service.startService(self)
+    self.refresher = task.LoopingCall(self.load)
+    self.refresher.clock = reactor
+    self.refresher.start(self.refresh_interval, now=True)
+
+  def stopService(self):
+    service.Service.stopService(self)
+    if self.refresher is not None and self.refresher.running:
+      self.refresher.stop()
+    self.refresher = None
+
+  def load(self):
+    if self.loading:
+      return
+    self.loading = True
+    deferred = self.storage.users()
+    deferred.addCallbacks(self.loadResult, self.loadFailure)
+
+  def loadResult(self, rs):
+    self.loading = False
+    users = {}
+    changed = 0
+    for row in rs:
+      username = self.key(row[0])
+      entry = tuple(row[1:])
+      users[username] = entry
+      if self.users.get(username) != entry:
+        changed += 1
+        self.missing.pop(username, None)
+    removed = len(set(self.users) - set(users))
+    self.users = users
+    self.loaded = True
+    self.stats['loads'] += 1
+    self.stats['changed'] += changed + removed
+    if changed or removed:
+      log.msg("User directory: %d users, %d changed, %d removed" % (len(users), changed, removed))
+
+  def loadFailure(self, failure):
+    self.loading = False
+    log.msg("User directory load failure: %s" % str(failure))
+
+  def key(self, username):
+    if isinstance(username, str):
+      return username.encode('utf8')
+    return bytes(username)
+
+  def lookup(self, username):
+    # fires with a list of zero or one (password, hide_in_room,
+    # moderator, sort_order) rows, like the query it replaces
+    entry = self.users.get(username)
+    if self.breaker is not None and self.breaker.isOpen():
+      verified = self.last_verified.get(username)
+      if entry is not None and verified is not None and verified + self.degraded_window > reactor.seconds():
+        self.stats['degraded'] += 1
+        return defer.succeed([entry])
+      self.stats['degraded_refused'] += 1
+      return defer.fail(BreakerOpen("database unavailable"))
+    if entry is not None:
+      self.stats['hits'] += 1
+      return defer.succeed([entry])
+    expires = self.missing.get(username)
+    if expires is not None:
+      if expires > reactor.seconds():
+        self.stats['negative_hits'] += 1
+        return defer.succeed([])
+      del self.missing[username]
+    if self.loaded and self.miss_queries >= self.max_miss_queries:
+      self.stats['refused'] += 1
+      return defer.succeed([])
+    self.stats['queries'] += 1
+    self.miss_queries += 1
+    deferred = self.storage.user(username)
+    deferred.addBoth(self.lookupDone)
+    deferred.addCallback(self.lookupResult, username)
+    return deferred
+
+  def verified(self, username):
+    self.last_verified[username] = reactor.seconds()
+
+  def lookupDone(self, result):
+    self.miss_queries -= 1
+    return result
+
+  def lookupResult(self, rs, username):
+    if len(rs) > 0:
+      self.users[username] = tuple(rs[0])
+    else:
+      self.missing.pop(username, None)
+      self.missing[username] = reactor.seconds() + self.negative_ttl
+      while len(self.missing) > self.negative_max:
+        self.missing.popitem(last=False)
+    return rs
+
+  def logStats(self):
+    s = self.stats
+    log.msg("%d users in directory, %d missing: %d hits, %d negative hits, %d queries, %d refused, %d degraded logins, %d refused degraded" % (len(self.users), len(self.missing), s['hits'], s['negative_hits'], s['queries'], s['refused'], s['degraded'], s['degraded_refused']))
@@ -18,9 +18,16 @@
 
 import struct
 import colorsys
+import bisect
 
 class UserInfo:
 
+  _fmt = struct.Struct('>HH4xL6xH6xHHHH2xHHH20x')
+  
+  # roomPlayerDataChunk results and the sort key are cached; setting any
+  # of these attributes (or changing colors through set_colors) drops them
+  _chunk_attrs = frozenset([ 'user_id', 'username', 'chatname', 'player_info', 'in_game', 'afk', 'moderator' ])
+
   rainbow = [
     [192*257,       0,       0],
     [248*257,       0,       0],
@@ -32,6 +39,8 @@ class UserInfo:
     [ 96*257,       0,  96*257],
   ]
   
+  _palettes = {}
+  
   @staticmethod
   def rainbow_for_pos(pos, total):
     total = max(total, 6)
@@ -39,12 +48,26 @@ class UserInfo:
     frac = wrappos / float(total)
     red, green, blue = colorsys.hls_to_rgb(frac, 0.5, 1.0)
     return (int(red * 65535), int(green * 65535), int(blue * 65535))
+  
+  @staticmethod
+  def rainbow_palette(total):
+    # colors for every position in a room of this size; rainbow_for_pos
+    # wraps around, so position n uses palette[n % len(palette)]
+    total = max(total, 6)
+    palette = UserInfo._palettes.get(total)
+    if palette is None:
+      palette = UserInfo._palettes[total] = [ UserInfo.rainbow_for_pos(pos, total) for pos in range(total) ]
+    return palette
 
   def __init__(self, uid, connection, token):
+    self._chunks = {}
+    self._sort_key = None
+    self.announced_chunk = None
     self.user_id = uid
     self.sort_id = None
     self.userd_connection = connection
     self.roomd_connection = None
+    self.held = None            # the dropped Roomd connection, while it can be resumed
     self.username = None
     self.chatname = None
     self.game = None
@@ -58,11 +81,25 @@ class UserInfo:
     self.original_player_color = None
     self.original_team_color = None
   
+  def __setattr__(self, name, value):
+    if name in self._chunk_attrs:
+      self._chunks.clear()
+      object.__setattr__(self, '_sort_key', None)
+    object.__setattr__(self, name, value)
+  
   def set_player_info(self, player_info):
     self.player_info = player_info
     self.original_player_color = player_info.player_color
     self.original_team_color = player_info.team_color
   
+  def set_colors(self, player_color, team_color):
+    if tuple(self.player_info.player_color) == tuple(player_color) and tuple(self.player_info.team_color) == tuple(team_color):
+      return False
+    self.player_info.player_color = player_color
+    self.player_info.team_color = team_color
+    self._chunks.clear()
+    return True
+  
   def away_status(self):
     return 1 if (self.in_game or self.afk) else 0
   
@@ -83,8 +120,12 @@ class UserInfo:
     return teamname
   
   def roomPlayerDataChunk(self, verb):
-    _fmt = struct.Struct('>HH4xL6xH6xHHHH2xHHH20x')
-    
+    chunk = self._chunks.get(verb)
+    if chunk is None:
+      chunk = self._chunks[verb] = self.buildPlayerDataChunk(verb)
+    return chunk
+  
+  def buildPlayerDataChunk(self, verb):
     chatname = self.chatname
     if chatname is None:
       chatname = b'|iUnknown|p'
@@ -99,10 +140,65 @@ class UserInfo:
     if not self.in_game and self.afk is not None:
       chatname = b'|i' + self.afk + b'|p-' + chatname
     
-    return _fmt.pack(verb, self.flags(), self.user_id, 40 + len(chatname) + len(teamname), self.away_status(), color[0], color[1], color[2], team[0], team[1], team[2]) + chatname + b'\x00' + teamname + b'\x00'
+    return self._fmt.pack(verb, self.flags(), self.user_id, 40 + len(chatname) + len(teamname), self.away_status(), color[0], color[1], color[2], team[0], team[1], team[2]) + chatname + b'\x00' + teamname + b'\x00'
+  
+  def sort_key(self):
+    # present players before away ones, then by user id
+    key = self._sort_key
+    if key is None:
+      key = (0 - self.flags(), 0 - self.away_status(), self.user_id)
+      object.__setattr__(self, '_sort_key', key)
+    return key
   
   def __eq__(self, other):
     return self.user_id == other.user_id
   
   def __lt__(self, other):
-    return ((other.flags(), other.away_status(), self.user_id) < (self.flags(), self.away_status(), other.user_id))
+    return self.sort_key() < other.sort_key()
+
+
+class RoomRoster:
+  # The room's visible members, kept in UserInfo sort order.
+
+  def __init__(self):
+    self.members = {}
+    self.moderators = set()
+    self._order = []
+    self._keys = {}
+  
+  def __len__(self):
+    return len(self.members)
+  
+  def __contains__(self, user_id):
+    return user_id in self.members
+  
+  def get(self, user_id):
+    return self.members.get(user_id)
+  
+  def update(self, user_info):
+    # adds the user, or moves them if their sort key has changed
+    uid = user_info.user_id
+    key = user_info.sort_key()
+    old_key = self._keys.get(uid)
+    if old_key == key and self.members.get(uid) is user_info:
+      return
+    if old_key is not None:
+      self.discard(self.members[uid])
+    self.members[uid] = user_info
+    self._keys[uid] = key
+    bisect.insort(self._order, (key, uid))
+    if user_info.moderator:
+      self.moderators.add(uid)
+  
+  def discard(self, user_info):
+    uid = user_info.user_id
+    if self.members.get(uid) is not user_info:
+      return
+    key = self._keys.pop(uid)
+    del self._order[bisect.bisect_left(self._order, (key, uid))]
+    del self.members[uid]
+    self.moderators.discard(uid)
+  
+  def ordered(self):
+    members = self.members
+    return [ members[uid] for key, uid in self._order ]
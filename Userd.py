@@ -17,15 +17,20 @@
 # along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
 
 from twisted.internet.protocol import Factory
-from twisted.internet import reactor
 from twisted.python import log
 from MetaProtocol import MetaProtocol
 from MetaPackets import *
 from GameInfo import GameInfo
-from UserInfo import UserInfo
-import uuid
+from UserInfo import UserInfo, RoomRoster
+from PasswordVerifier import PasswordVerifier, VerifierBusy
+from HostResolver import HostResolver
+from RemoteHubRegistry import RemoteHubRegistry
+from UserDirectory import UserDirectory
+from LogWriter import LogWriter
+from CircuitBreaker import BreakerOpen
+from Storage import MemoryStorage
+from TokenStore import TokenStore
 import os
-import bcrypt
 
 def inc_wrap(num, min, max):
   if num >= max:
@@ -40,14 +45,24 @@ class Userd(MetaProtocol):
   NEED_PWHASH = 2
   NEED_VERSION = 3
   LOGGED_IN = 4
+  DISCONNECTED = 5
   
-  def __init__(self, factory, roomd_host=None, roomd_port=6335, dbpool=None):
+  _recv_packets = [
+    (LoginPacket, 'handleLoginPacket', [NEED_LOGIN]),
+    (PasswordResponsePacket, 'handlePasswordResponsePacket', [NEED_PASSWORD]),
+    (LocalizationPacket, 'handleLocalizationPacket', [NEED_VERSION]),
+    (RemoteHubRequestPacket, 'handleRemoteHubRequestPacket', [LOGGED_IN]),
+    (LogoutPacket, 'handleLogoutPacket', None),
+    (IncomingKeepAlivePacket, None, None) ]
+  
+  def __init__(self, factory, roomd_host=None, roomd_port=6335, storage=None):
     MetaProtocol.__init__(self)
     self.factory = factory
     self.globals = factory.globals
     self.roomd_host = roomd_host
     self.roomd_port = roomd_port
-    self.dbpool = dbpool
+    self.storage = storage
+    self.verifying = None
   
   def connectionMade(self):
     MetaProtocol.connectionMade(self)
@@ -57,35 +72,17 @@ class Userd(MetaProtocol):
     if self.roomd_host is None:
       self.roomd_host = self.transport.getHost().host
   
-  def packetReceived(self, packet):
-    # self.factory.debugGlobals()
-  
-    if isinstance(packet, LoginPacket):
-      return self.handleLoginPacket(packet)
-    if isinstance(packet, PasswordResponsePacket):
-      return self.handlePasswordResponsePacket(packet)
-    if isinstance(packet, LocalizationPacket):
-      return self.handleLocalizationPacket(packet)
-    if isinstance(packet, RemoteHubRequestPacket):
-      return self.handleRemoteHubRequestPacket(packet)  
-    if isinstance(packet, LogoutPacket):
-      return self.handleLogoutPacket(packet)
-    return False
+  def packetRejected(self, code):
+    self.sendMessage(MessagePacket.SYNTAX_ERROR)
   
   def handleRemoteHubRequestPacket(self, packet):
-    if self.state != self.LOGGED_IN:
-      self.sendMessage(MessagePacket.SYNTAX_ERROR)
-      return False
     
-    deferred = self.dbpool.runQuery("SELECT id, host, port FROM remotehub WHERE network_version = %s", (packet.network_version, ))
+    deferred = self.factory.remote_hubs.hubList(packet.network_version)
     deferred.addCallback(self.remoteHubLookupResult)
     deferred.addErrback(self.remoteHubLookupFailure)
     return True
   
   def handleLoginPacket(self, packet):
-    if self.state != self.NEED_LOGIN:
-      self.sendMessage(MessagePacket.SYNTAX_ERROR)
-      return False
     
     self.user_info.set_player_info(packet)
     if packet.username == b'guest' or packet.username == b'':
@@ -93,6 +90,10 @@ class Userd(MetaProtocol):
       self.state = self.NEED_VERSION
       self.sendPacket(AcceptPacket())
     else:
+      uid = self.globals['usernames'].get(packet.username)
+      if uid is not None and self.globals['users'][uid].held is not None:
+        # dropped from the room moments ago and back the long way round
+        self.globals['users'][uid].held.depart()
       if packet.username in self.globals['usernames']:
         self.sendMessage(MessagePacket.USER_LOGGED_IN)
         return False
@@ -108,17 +109,14 @@ class Userd(MetaProtocol):
     return True
   
   def handlePasswordResponsePacket(self, packet):
-    if self.state != self.NEED_PASSWORD:
-      self.sendMessage(MessagePacket.SYNTAX_ERROR)
-      return False
     packet.decode_password(self.seed_auth, self.seed)
     self.state = self.NEED_PWHASH
     if self.seed_auth == 0:
-      deferred = self.dbpool.runQuery("SELECT password, hide_in_room, moderator, sort_order FROM user WHERE BINARY username = %s", (self.user_info.username,))
+      deferred = self.factory.directory.lookup(self.user_info.username)
       deferred.addCallback(self.passwordLookupResult, packet.password)
       deferred.addErrback(self.passwordLookupFailure)
     elif self.seed_auth == 4:
-      deferred = self.dbpool.runQuery("SELECT meta_login_token, meta_login_token_date + INTERVAL 60 SECOND > NOW(), hide_in_room, moderator, sort_order FROM user WHERE BINARY username = %s", (self.user_info.username,))
+      deferred = self.storage.loginToken(self.user_info.username)
       deferred.addCallback(self.passwordTokenResult, packet.password)
       deferred.addErrback(self.passwordLookupFailure)
     else:
@@ -127,27 +125,29 @@ class Userd(MetaProtocol):
     return True
   
   def passwordTokenResult(self, rs, saved_pw):
+    if self.state == self.DISCONNECTED:
+      return
     if self.state != self.NEED_PWHASH:
       log.msg("Password lookup called in wrong context")
-      self.transport.loseConnection()
+      self.loseConnection()
       return
     if len(rs) < 1:
       log.msg("Username not found in database: %s" % self.user_info.username)
       self.sendMessage(MessagePacket.BAD_USER)
-      self.transport.loseConnection()
+      self.loseConnection()
       return
     if rs[0][0] != saved_pw:
       log.msg("Password check failed for %s" % self.user_info.username)
       self.sendMessage(MessagePacket.BAD_USER)
-      self.transport.loseConnection()
+      self.loseConnection()
       return
     if not rs[0][1]:
       log.msg("Token out of date for %s" % self.user_info.username)
       self.sendMessage(MessagePacket.BAD_USER)
-      self.transport.loseConnection()
+      self.loseConnection()
       return
     log.msg("Password accepted for %s" % self.user_info.username)
-    self.dbpool.runOperation("UPDATE user SET meta_login_token = NULL, meta_login_token_date = NULL WHERE BINARY username = %s", (self.user_info.username,))
+    self.storage.clearLoginToken(self.user_info.username)
     self.state = self.NEED_VERSION
     if rs[0][2]:
       self.user_info.visible = False
@@ -158,21 +158,36 @@ class Userd(MetaProtocol):
     self.sendPacket(AcceptPacket())
   
   def passwordLookupResult(self, rs, saved_pw):
+    if self.state == self.DISCONNECTED:
+      return
     if self.state != self.NEED_PWHASH:
       log.msg("Password lookup called in wrong context")
-      self.transport.loseConnection()
+      self.loseConnection()
       return
     if len(rs) < 1:
       log.msg("Username not found in database: %s" % self.user_info.username)
       self.sendMessage(MessagePacket.BAD_USER)
-      self.transport.loseConnection()
+      self.loseConnection()
+      return
+    self.verifying = self.factory.verifier.verify(saved_pw.decode('mac_roman').encode('utf8'), rs[0][0].encode('utf8'))
+    self.verifying.addCallback(self.passwordCheckResult, rs)
+    self.verifying.addErrback(self.passwordCheckFailure)
+  
+  def passwordCheckResult(self, match, rs):
+    self.verifying = None
+    if self.state == self.DISCONNECTED:
       return
-    if not bcrypt.checkpw(saved_pw.decode('mac_roman').encode('utf8'), rs[0][0].encode('utf8')):
+    if self.state != self.NEED_PWHASH:
+      log.msg("Password check called in wrong context")
+      self.loseConnection()
+      return
+    if not match:
       log.msg("Password check failed for %s" % self.user_info.username)
       self.sendMessage(MessagePacket.BAD_USER)
-      self.transport.loseConnection()
+      self.loseConnection()
       return
     log.msg("Password accepted for %s" % self.user_info.username)
+    self.factory.directory.verified(self.user_info.username)
     self.state = self.NEED_VERSION
     if rs[0][1]:
       self.user_info.visible = False
@@ -183,41 +198,49 @@ class Userd(MetaProtocol):
     self.sendPacket(AcceptPacket())
   
   def passwordLookupFailure(self, failure):
-    log.msg("Password lookup failure: %s" % str(failure))
-    self.transport.loseConnection()
+    if self.state == self.DISCONNECTED:
+      return
+    if failure.check(BreakerOpen):
+      log.msg("Login refused for %s: %s" % (self.user_info.username, failure.getErrorMessage()))
+      self.sendMessage(MessagePacket.GAMES_NOT_ALLOWED)
+    else:
+      log.msg("Password lookup failure: %s" % str(failure))
+    self.loseConnection()
+  
+  def passwordCheckFailure(self, failure):
+    self.verifying = None
+    if self.state == self.DISCONNECTED:
+      return
+    if failure.check(VerifierBusy):
+      log.msg("Password check refused for %s: %s" % (self.user_info.username, failure.getErrorMessage()))
+      self.sendMessage(MessagePacket.GAMES_NOT_ALLOWED)
+    else:
+      log.msg("Password check failure: %s" % str(failure))
+    self.loseConnection()
 
-  def remoteHubLookupResult(self, rs):
+  def remoteHubLookupResult(self, packet):
+    if self.state == self.DISCONNECTED:
+      return
     if self.state != self.LOGGED_IN:
       log.msg("Remote hub request lookup called in wrong context")
-      self.transport.loseConnection()
+      self.loseConnection()
       return
-
-    games = self.globals['games'].values()
-    remote_servers = []
-    
-    for server_row in rs:
-      if any(game.remote_hub_id == server_row[0] for game in games):
-        continue
-      try:
-        ipaddress = socket.gethostbyname(server_row[1])
-      except:
-        log.msg("Can't resolve remote hub address from host %s" % server_row[1])
-        continue
-      remote_servers.append((server_row[0], ipaddress, server_row[2]))
-      
-    self.sendPacket(RemoteHubListPacket(remote_servers))
+    self.sendPacket(packet)
     
   def remoteHubLookupFailure(self, failure):
+    if self.state == self.DISCONNECTED:
+      return
     log.msg("Remote hub lookup failure: %s" % str(failure))
-    self.transport.loseConnection()
+    self.loseConnection()
   
   def handleLocalizationPacket(self, packet):
-    if self.state != self.NEED_VERSION:
-      self.sendMessage(MessagePacket.SYNTAX_ERROR)
-      return False
     self.state = self.LOGGED_IN
-    self.globals['tokens'][self.token]['active'] = True
-    self.sendPacket(LoginSuccessfulPacket(self.user_id, self.token))
+    self.factory.tokens.activate(self.token)
+    token = self.token
+    if self.factory.signer is not None:
+      uinfo = self.user_info
+      token = self.factory.signer.issue(self.user_id, uinfo.username, uinfo.moderator, uinfo.visible, uinfo.sort_id)
+    self.sendPacket(LoginSuccessfulPacket(self.user_id, token))
     self.sendPacket(RoomListPacket(self.roomd_host, self.roomd_port))
     return True
   
@@ -233,10 +256,14 @@ class Userd(MetaProtocol):
       token = uinfo.token
       if self.state == self.LOGGED_IN:
         # give client time to connect to roomd
-        reactor.callLater(self.TOKEN_TIMEOUT, self.factory.expireToken, token)
+        self.factory.tokens.expireLater(token, self.TOKEN_TIMEOUT)
       else:
         self.factory.expireToken(token)
       self.factory.cleanUser(self.user_id)
+    # pending database and password callbacks check for this and return
+    self.state = self.DISCONNECTED
+    if self.verifying is not None:
+      self.verifying.cancel()
     self.factory.debugGlobals()
 
 class UserdFactory(Factory):
@@ -245,46 +272,53 @@ class UserdFactory(Factory):
   MIN_GAME_ID = 10000
   MAX_GAME_ID = 60000
   
-  def __init__(self, roomd_host=None, roomd_port=6335, options=None, dbpool=None):
+  def __init__(self, roomd_host=None, roomd_port=6335, options=None, storage=None, verifier=None, resolver=None, remote_hubs=None, directory=None, logwriter=None, signer=None):
 #     Factory.__init__(self)
     self.globals = {
       'users': {},
-      'tokens' : {},
       'usernames' : {},
       'games' : {},
+      'roster' : RoomRoster(),
+      'listening' : {},
       'rainbow' : None }
     self.last_user_id = 10000
     self.last_game_id = 40000
     self.roomd_host = roomd_host
     self.roomd_port = roomd_port
     self.options = options
-    self.dbpool = dbpool
+    self.storage = storage if storage is not None else MemoryStorage()
+    self.verifier = verifier if verifier is not None else PasswordVerifier()
+    self.resolver = resolver if resolver is not None else HostResolver()
+    self.remote_hubs = remote_hubs if remote_hubs is not None else RemoteHubRegistry(self.storage, self.resolver)
+    self.directory = directory if directory is not None else UserDirectory(self.storage)
+    self.logwriter = logwriter if logwriter is not None else LogWriter(self.storage)
+    self.tokens = TokenStore(self.tokenExpired)
+    self.signer = signer
   
   def buildProtocol(self, addr):
-    return Userd(self, self.roomd_host, self.roomd_port, self.dbpool)
+    return Userd(self, self.roomd_host, self.roomd_port, self.storage)
   
   def expireToken(self, token):
-    tokeninfo = self.globals['tokens'].pop(token, None)
-    if tokeninfo is not None:
-      uid = tokeninfo['user_id']
-      if uid in self.globals['users']:
-        self.globals['users'][uid].token = None
-        self.cleanUser(uid)
+    uid = self.tokens.expire(token)
+    if uid is not None:
+      self.tokenExpired(token, uid)
+
+  def tokenExpired(self, token, uid):
+    if uid in self.globals['users']:
+      self.globals['users'][uid].token = None
+      self.cleanUser(uid)
 
   def redeemToken(self, token):
-    tokeninfo = self.globals['tokens'].pop(token, None)
+    uid, redeemed = self.tokens.redeem(token)
     self.debugGlobals()
-    if tokeninfo is not None:
-      uid = tokeninfo['user_id']
-      if uid in self.globals['users']:
-        self.globals['users'][uid].token = None
-      if tokeninfo['active']:
-        return uid
-    return None
+    if uid is not None and uid in self.globals['users']:
+      self.globals['users'][uid].token = None
+    return uid if redeemed else None
 
   def expireGame(self, game_id):
     gameinfo = self.globals['games'].pop(game_id, None)
     if gameinfo is not None:
+      self.remote_hubs.release(gameinfo.remote_hub_id, game_id)
       uid = gameinfo.user_id
       if uid in self.globals['users']:
         self.globals['users'][uid].game = None
@@ -292,7 +326,7 @@ class UserdFactory(Factory):
   def cleanUser(self, user_id):
     if user_id in self.globals['users']:
       uinfo = self.globals['users'][user_id]
-      if uinfo.userd_connection is None and uinfo.roomd_connection is None and uinfo.token is None:
+      if uinfo.userd_connection is None and uinfo.roomd_connection is None and uinfo.token is None and uinfo.held is None:
         if uinfo.username in self.globals['usernames']:
           del self.globals['usernames'][uinfo.username]
         self.expireGame(uinfo.game)
@@ -304,7 +338,7 @@ class UserdFactory(Factory):
       uid = inc_wrap(uid, self.MIN_USER_ID, self.MAX_USER_ID)
     self.last_user_id = uid
 
-    token = self.buildToken(uid)
+    token = self.tokens.issue(uid)
     self.globals['users'][uid] = UserInfo(uid, connection, token)
     return uid, token
 
@@ -318,27 +352,14 @@ class UserdFactory(Factory):
     self.globals['users'][user_id].game = gid
     return gid
   
-  def buildToken(self, user_id):
-    # TODO: convince GvR to give us do-while
-    token = uuid.uuid4().hex.encode('ascii')
-    while token in self.globals['tokens']:
-      token = uuid.uuid4().hex.encode('ascii')
-    self.globals['tokens'][token] = {
-      'active' : False,
-      'user_id' : user_id }
-    return token
-  
   def debugGlobals(self):
     
-    numTokens = 0
-    numActiveTokens = 0
-    for k, v in self.globals['tokens'].items():
-      numTokens += 1
-      if v['active']:
-        numActiveTokens += 1
-      if not v['user_id'] in self.globals['users']:
-        log.msg("Bad user id %d for token %s" % (v['user_id'], k))
-    log.msg("%d tokens (%d active)" % (numTokens, numActiveTokens))
+    for token, user_id, active in self.tokens.tokens():
+      if not user_id in self.globals['users']:
+        log.msg("Bad user id %d for token %s" % (user_id, token))
+    self.tokens.logStats()
+    if self.signer is not None:
+      self.signer.logStats()
     
     numUsernames = 0
     for k, v in self.globals['usernames'].items():
@@ -377,6 +398,26 @@ class UserdFactory(Factory):
           log.msg("Duplicate username %s for user id %d" % (name, k))
         seen_usernames[name] = k
     log.msg("%d users (%d in userd, %d in roomd, %d named)" % (numUsers, numInUserd, numInRoomd, numRegistered))
+    
+    for which, members in (('visible', self.globals['roster'].members), ('listening', self.globals['listening'])):
+      for k, uinfo in members.items():
+        if self.globals['users'].get(k) is not uinfo or (uinfo.roomd_connection is None and (which == 'listening' or uinfo.held is None)):
+          log.msg("Stale %s room member %d" % (which, k))
+    log.msg("%d visible, %d listening in room" % (len(self.globals['roster']), len(self.globals['listening'])))
+    
+    stats = MetaProtocol.outbound_stats
+    log.msg("%d packets sent in %d writes (%d writes saved)" % (stats['frames'], stats['writes'], stats['frames'] - stats['writes']))
+    MetaProtocol.keepalive.logStats()
+    self.verifier.logStats()
+    self.resolver.logStats()
+    self.remote_hubs.logStats()
+    self.directory.logStats()
+    self.logwriter.logStats()
+    storages = []
+    for storage in (self.storage, self.directory.storage, self.remote_hubs.storage):
+      if storage not in storages:
+        storages.append(storage)
+        storage.logStats()
       
   
     
@@ -0,0 +1,101 @@
+# Copyright (C) 2014 and beyond by Jeremiah Morris
+# and contributing developers.
+#
+# This file is part of Metaserver.
+#
+# Metaserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Metaserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+import LogSpool
+import os
+
+class FakeStorage:
+
+  breaker = None
+
+  def __init__(self):
+    self.inserted = []
+
+  def insertRows(self, table, columns, rows):
+    self.inserted.extend(rows)
+    return defer.succeed(None)
+
+class LogSpoolTest(unittest.TestCase):
+
+  columns = ('user_id', 'message')
+
+  def setUp(self):
+    self.clock = task.Clock()
+    self.patch(LogSpool, 'reactor', self.clock)
+    self.path = self.mktemp()
+    self.storage = FakeStorage()
+
+  def startSpool(self):
+    spool = LogSpool.LogSpool(self.storage, self.path)
+    # file work runs inline rather than on the spool's thread
+    spool.inThread = lambda f, *args: defer.maybeDeferred(f, *args)
+    spool.startService()
+    self.addCleanup(spool.threadpool.stop)
+    self.addCleanup(spool.replayer.stop)
+    return spool
+
+  def writeSpool(self, data):
+    with open(self.path, 'wb') as f:
+      f.write(data)
+
+  def test_replay(self):
+    spool = self.startSpool()
+    spool.append('chat_log', self.columns, [ (1, 'one'), (2, 'two') ])
+    self.clock.advance(spool.sync_interval)
+    self.assertEqual(spool.backlog(), os.path.getsize(self.path))
+    spool.replay()
+    self.assertEqual(self.storage.inserted, [ (1, 'one'), (2, 'two') ])
+    self.assertEqual(spool.backlog(), 0)
+    self.assertEqual(os.path.getsize(self.path), 0)
+
+  def test_partialRecordAfterCrash(self):
+    good = LogSpool.encodeRecord('chat_log', self.columns, [ (1, 'before') ])
+    partial = LogSpool.encodeRecord('chat_log', self.columns, [ (2, 'torn') ])[:-3]
+    self.writeSpool(good + partial)
+    spool = self.startSpool()
+    self.assertEqual(spool.size, len(good))
+    self.assertEqual(os.path.getsize(self.path), len(good))
+    spool.append('chat_log', self.columns, [ (3, 'after') ])
+    self.clock.advance(spool.sync_interval)
+    spool.replay()
+    self.assertEqual(self.storage.inserted, [ (1, 'before'), (3, 'after') ])
+
+  def test_damagedRecordAfterCrash(self):
+    good = LogSpool.encodeRecord('chat_log', self.columns, [ (1, 'before') ])
+    damaged = bytearray(LogSpool.encodeRecord('chat_log', self.columns, [ (2, 'torn') ]))
+    damaged[-2] ^= 0xff
+    self.writeSpool(good + bytes(damaged))
+    spool = self.startSpool()
+    self.assertEqual(spool.size, len(good))
+    spool.append('chat_log', self.columns, [ (3, 'after') ])
+    self.clock.advance(spool.sync_interval)
+    spool.replay()
+    self.assertEqual(self.storage.inserted, [ (1, 'before'), (3, 'after') ])
+
+  def test_replayedPrefixKept(self):
+    first = LogSpool.encodeRecord('chat_log', self.columns, [ (1, 'done') ])
+    second = LogSpool.encodeRecord('chat_log', self.columns, [ (2, 'pending') ])
+    self.writeSpool(first + second + b'\0\0')
+    with open(self.path + '.pos', 'w') as f:
+      f.write('%d\n' % len(first))
+    spool = self.startSpool()
+    self.assertEqual(spool.backlog(), len(second))
+    spool.replay()
+    self.assertEqual(self.storage.inserted, [ (2, 'pending') ])
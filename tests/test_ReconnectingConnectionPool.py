@@ -0,0 +1,82 @@
+# Copyright (C) 2014 and beyond by Jeremiah Morris
+# and contributing developers.
+#
+# This file is part of Metaserver.
+#
+# Metaserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Metaserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.trial import unittest
+from ReconnectingConnectionPool import ReconnectingConnectionPool
+import threading
+
+class FakeConnection:
+
+  def __init__(self):
+    self.closed = False
+
+  def close(self):
+    self.closed = True
+
+class FakeDBAPI:
+
+  def __init__(self):
+    self.opened = []
+
+  def connect(self, *args, **kw):
+    conn = FakeConnection()
+    self.opened.append(conn)
+    return conn
+
+class ReconnectingConnectionPoolTest(unittest.TestCase):
+
+  def makePool(self, **kw):
+    pool = ReconnectingConnectionPool('sqlite3', ':memory:', **kw)
+    pool.dbapi = FakeDBAPI()
+    self.addCleanup(lambda: pool.running and pool.close())
+    return pool
+
+  def test_startWithoutMinimum(self):
+    pool = self.makePool(cp_min=0, cp_max=2)
+    pool.start()
+    self.assertTrue(pool.running)
+    self.assertEqual(pool.dbapi.opened, [])
+
+  def test_startOpensMinimum(self):
+    pool = self.makePool(cp_min=2, cp_max=2)
+    pool.start()
+    for i in range(200):
+      if len(pool.connections) == 2:
+        break
+      threading.Event().wait(0.01)
+    self.assertEqual(len(pool.connections), 2)
+
+  def test_adjustClosesConnectionsOfExitedThreads(self):
+    pool = self.makePool(cp_min=1, cp_max=1)
+    opened = []
+    thread = threading.Thread(target=lambda: opened.append(pool.connect()))
+    thread.start()
+    thread.join()
+    self.assertIn(thread.ident, pool.connections)
+    pool.adjust()
+    self.assertNotIn(thread.ident, pool.connections)
+    self.assertTrue(opened[0].closed)
+
+  def test_disconnect(self):
+    pool = self.makePool(cp_min=1, cp_max=1)
+    conn = pool.connect()
+    self.assertIs(pool.connect(), conn)
+    pool.disconnect(conn)
+    self.assertTrue(conn.closed)
+    self.assertEqual(pool.connections, {})
+    self.assertRaises(Exception, pool.disconnect, conn)
@@ -0,0 +1,92 @@
+# Copyright (C) 2014 and beyond by Jeremiah Morris
+# and contributing developers.
+#
+# This file is part of Metaserver.
+#
+# Metaserver is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Metaserver is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metaserver. If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+import HostResolver
+import RemoteHubRegistry
+import socket
+import struct
+
+class FakeStorage:
+
+  def __init__(self, rows):
+    self.rows = rows
+    self.loads = []
+
+  def remoteHubs(self):
+    d = defer.Deferred()
+    self.loads.append(d)
+    return d
+
+  def finish(self):
+    for d in self.loads:
+      d.callback(self.rows)
+    self.loads = []
+
+def hubIds(packet):
+  return [ struct.unpack('>H', packet.data[i:i + 2])[0] for i in range(0, len(packet.data), 8) ]
+
+class RemoteHubRegistryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = task.Clock()
+    self.patch(HostResolver, 'reactor', self.clock)
+    self.patch(RemoteHubRegistry, 'reactor', self.clock)
+    self.storage = FakeStorage([
+      (1, '1.0', 'hub1.example', 6321),
+      (2, '1.0', 'hub2.example', 6321),
+      (3, '2.0', 'hub3.example', 6321) ])
+    addresses = { 'hub1.example' : '10.0.0.1', 'hub2.example' : '10.0.0.2', 'hub3.example' : '10.0.0.3' }
+    self.resolver = HostResolver.HostResolver(resolve=lambda host: defer.succeed(addresses[host]))
+    self.registry = RemoteHubRegistry.RemoteHubRegistry(self.storage, self.resolver)
+
+  def test_concurrentListsForDifferentVersions(self):
+    first = self.registry.hubList(b'1.0')
+    second = self.registry.hubList(b'2.0')
+    self.assertEqual(len(self.storage.loads), 1)
+    self.storage.finish()
+    self.assertEqual(hubIds(self.successResultOf(first)), [1, 2])
+    self.assertEqual(hubIds(self.successResultOf(second)), [3])
+
+  def test_concurrentLoadsShareOneQuery(self):
+    first = self.registry.load()
+    second = self.registry.load()
+    self.assertIsNot(first, second)
+    self.assertEqual(len(self.storage.loads), 1)
+    self.storage.finish()
+    self.assertIsNone(self.successResultOf(first))
+    self.assertIsNone(self.successResultOf(second))
+    self.assertEqual(self.registry.stats['loads'], 1)
+    self.registry.load()
+    self.assertEqual(len(self.storage.loads), 1)
+
+  def test_failedLoadGivesEmptyList(self):
+    first = self.registry.hubList(b'1.0')
+    self.storage.loads.pop().errback(RuntimeError('database down'))
+    self.assertEqual(self.successResultOf(first).data, b'')
+
+  def test_claimedHubLeavesList(self):
+    self.registry.load()
+    self.storage.finish()
+    self.assertTrue(self.registry.claim(2, 77))
+    packet = self.successResultOf(self.registry.hubList(b'1.0'))
+    self.assertEqual(hubIds(packet), [1])
+    self.assertEqual(packet.data[2:6], socket.inet_aton('10.0.0.1'))
+    self.registry.release(2, 77)
+    self.assertEqual(hubIds(self.successResultOf(self.registry.hubList(b'1.0'))), [1, 2])